@@ -47,6 +47,7 @@ from __future__ import with_statement
 import sys
 import warnings
 import os
+import re
 import fnmatch
 import glob
 import shutil
@@ -55,6 +56,53 @@ import hashlib
 import errno
 import tempfile
 import functools
+import contextlib
+import mmap
+import stat
+import Queue
+import threading
+import sqlite3
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import marshal
+import zlib
+import binascii
+import gzip
+import bz2
+import collections
+import itertools
+import array
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from .common import get_nice_size
+from .signals import Signal
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        pass
+
+try:
+    # path.aio needs trollius and the futures backport.
+    import trollius
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    pass
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        pass
 
 try:
     import win32security
@@ -66,12 +114,1285 @@ try:
 except ImportError:
     pass
 
+try:
+    import fcntl
+except ImportError:
+    pass
+
 __version__ = '3.0'
-__all__ = ['path']
+__all__ = ['path', 'hash_many', 'DigestCache', 'CopyStats',
+           'SyncReport', 'TreeSnapshot', 'GroupCommit',
+           'StatCache', 'PathTable', 'DiskUsage',
+           'find_duplicates', 'TreeWatcher', 'WatchEvent', 'IgnoreRules',
+           'FileIndex']
 
 class TreeWalkWarning(Warning):
     pass
 
+class HashWarning(Warning):
+    pass
+
+class WatchWarning(Warning):
+    pass
+
+# The standard end-of-line sequences, for 8-bit and for Unicode text.
+_NEWLINE = re.compile('\r\n|[\r\n]')
+_UNICODE_NEWLINE = re.compile(u'\r\n|\r\x85|[\r\n\x85\u2028]')
+
+# What unicode.splitlines() splits on: the standard end-of-line
+# sequences (group 1) plus a few separators it keeps as they are.
+_UNICODE_LINE_BREAK = re.compile(
+    u'(\r\n|\r\x85|[\r\n\x85\u2028])|[\x0b\x0c\x1c\x1d\x1e\u2029]')
+
+_MMAP_ACCESS = {
+    'r': mmap.ACCESS_READ,
+    'r+': mmap.ACCESS_WRITE,
+    'c': mmap.ACCESS_COPY,
+}
+
+# How much of a mapped file is handed to a hash object per update().
+_MMAP_CHUNK = 1 << 24
+
+def _open_gzip(filename, mode, level):
+    if level is None:
+        return gzip.GzipFile(filename, mode)
+    return gzip.GzipFile(filename, mode, level)
+
+def _open_bz2(filename, mode, level):
+    if level is None:
+        return bz2.BZ2File(filename, mode)
+    return bz2.BZ2File(filename, mode, compresslevel=level)
+
+def _open_xz(filename, mode, level):
+    if 'lzma' not in globals():
+        raise ValueError("xz compression needs the lzma module")
+    if level is None or mode.startswith('r'):
+        return lzma.LZMAFile(filename, mode)
+    return lzma.LZMAFile(filename, mode, preset=level)
+
+# Compression formats for path.open_stream(): name -> (file name
+# extensions, magic bytes at the start of the data, opener).
+_COMPRESSIONS = {
+    'gzip': (('.gz', '.tgz'), '\x1f\x8b', _open_gzip),
+    'bz2': (('.bz2', '.tbz2'), 'BZh', _open_bz2),
+    'xz': (('.xz', '.txz'), '\xfd7zXZ\x00', _open_xz),
+}
+
+def _read_size(size):
+    """
+    Pick the read size for streaming through a file of 'size' bytes:
+    small files are read in a single call, big ones in 1 MiB chunks.
+    """
+    return min(max(size + 1, 8192), 1 << 20)
+
+def _walk_error(errors, message, subject, exc_info=None):
+    """
+    Report an error according to the walk errors= policy: re-raise it
+    for 'strict', warn for 'warn', swallow it for 'ignore'.  Without
+    'exc_info' this reports the exception being handled, so it must be
+    called from inside an except block.
+    """
+    if exc_info is None:
+        exc_info = sys.exc_info()
+    if errors == 'warn':
+        warnings.warn(message % (subject, exc_info[1]), TreeWalkWarning)
+    elif errors != 'ignore':
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+class _DirEntry(object):
+    """
+    Stand-in for os.DirEntry used when scandir is not available.  On
+    Linux the listing comes from the C library readdir(), whose entry
+    type, 'mode' here, answers is_dir() and friends without a system
+    call, as with scandir.  Otherwise the lstat() of the entry is done
+    once, on demand, and cached together with the stat() of a symlink
+    target, so asking for the type of an entry more than once never
+    hits the filesystem again.
+    """
+    __slots__ = ('name', 'path', '_mode', '_stat', '_lstat')
+
+    def __init__(self, name, path, mode=0):
+        self.name = name
+        self.path = path
+        self._mode = mode
+        self._stat = None
+        self._lstat = None
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+    def stat(self, follow_symlinks=True):
+        st = self._lstat
+        if st is None:
+            if follow_symlinks and self._mode == stat.S_IFLNK:
+                st = self._stat
+                if st is None:
+                    st = self._stat = os.stat(self.path)
+                return st
+            st = self._lstat = os.lstat(self.path)
+        if follow_symlinks and st.st_mode & 0170000 == stat.S_IFLNK:
+            st = self._stat
+            if st is None:
+                st = self._stat = os.stat(self.path)
+        return st
+
+    def _format(self, follow_symlinks):
+        mode = self._mode
+        if mode and not (follow_symlinks and mode == stat.S_IFLNK):
+            return mode
+        try:
+            return self.stat(follow_symlinks).st_mode & 0170000
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def is_dir(self, follow_symlinks=True):
+        return self._format(follow_symlinks) == stat.S_IFDIR
+
+    def is_file(self, follow_symlinks=True):
+        return self._format(follow_symlinks) == stat.S_IFREG
+
+    def is_symlink(self):
+        return self._format(False) == stat.S_IFLNK
+
+    def __repr__(self):
+        return '<_DirEntry %r>' % self.name
+
+if 'scandir' in globals():
+    def _scandir(directory):
+        """ Return the list of directory entries of 'directory'. """
+        return list(scandir(directory))
+else:
+    def _scandir(directory):
+        """ Return the list of directory entries of 'directory'. """
+        prefix = os.path.join(unicode(directory), u'')
+        if not _have_fd_calls():
+            return [_DirEntry(name, prefix + name)
+                    for name in os.listdir(directory)]
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        entries = []
+        for name, kind in _list_dir(_fs_encode(directory)):
+            try:
+                name = name.decode(encoding)
+            except UnicodeDecodeError:
+                # Like os.listdir(), keep the bytes.
+                pass
+            # A dirent type is the file type of a mode, shifted.
+            entries.append(_DirEntry(name, prefix + name, kind << 12))
+        return entries
+
+_matchers = {}
+
+def _name_matcher(pattern):
+    """
+    Return a function telling whether a file name matches 'pattern',
+    with the semantics of fnmatch.fnmatch().  The pattern is compiled
+    once and the result cached, so matching many names only costs a
+    regular expression match each.
+    """
+    try:
+        return _matchers[pattern]
+    except KeyError:
+        pass
+    normcase = os.path.normcase
+    match = re.compile(fnmatch.translate(normcase(pattern))).match
+    if normcase('A') != 'A' or normcase('/') != '/':
+        match = lambda name, match=match: match(normcase(name))
+    if len(_matchers) >= 100:
+        _matchers.clear()
+    _matchers[pattern] = match
+    return match
+
+def _walk_select(walker, pattern, errors, kind=None):
+    """
+    Filter the (path, entry, isdir) triples produced by a walk engine
+    down to the path objects a walk method yields.  'kind' is None for
+    everything, 'dirs' for directories only or 'files' for regular
+    files only.
+    """
+    match = _name_matcher(pattern) if pattern is not None else None
+    for child, entry, isdir in walker:
+        if kind == 'dirs':
+            if not isdir:
+                continue
+        elif kind == 'files':
+            if isdir:
+                continue
+            try:
+                isfile = entry.is_file()
+            except Exception:
+                _walk_error(errors, "Unable to access '%s': %s", child)
+                continue
+            if not isfile:
+                continue
+        if match is None or match(entry.name):
+            yield child
+
+def _gitignore_regex(pattern):
+    """ Translate the glob of a gitignore rule to a regular expression
+    source, matched against '/' separated paths.
+    """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**' and (i == 0 or pattern[i - 1] == '/'):
+                if i + 2 == n:
+                    # 'a/**': everything inside a.
+                    out.append('.*')
+                    i += 2
+                    continue
+                if pattern[i + 2] == '/':
+                    # '**/': any number of directories, even none.
+                    out.append('(?:.*/)?')
+                    i += 3
+                    continue
+            out.append('[^/]*')
+            while i < n and pattern[i] == '*':
+                i += 1
+            continue
+        if c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                out.append('\\[')
+            else:
+                chars = pattern[i + 1:j].replace('\\', '\\\\')
+                if chars[:1] in ('!', '^'):
+                    chars = '^' + chars[1:]
+                out.append('[%s]' % chars)
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+class IgnoreRules(object):
+    """
+    A compiled set of .gitignore style rules, to leave files and whole
+    subtrees out of path.walk() and the other walk methods:
+
+        rules = IgnoreRules(['*.pyc', 'build/', '!build/keep.txt'],
+                            ignore_file='.gitignore')
+        for f in d.walkfiles(ignore=rules):
+            ...
+
+    The rules follow gitignore(5): blank lines and lines starting with
+    '#' are skipped, '!' negates a rule, a trailing '/' makes a rule
+    match only directories, a rule with a '/' elsewhere is anchored to
+    its directory while one without matches at any depth, '*', '?' and
+    '[...]' do not match '/' and '**' matches any number of
+    directories.  The last rule matching a path decides.
+
+    With 'ignore_file' the walk also reads that file from every
+    directory that has one and applies its rules, relative to that
+    directory, below it.  An ignored directory is not listed at all,
+    so nothing inside it can be included again.
+    """
+
+    def __init__(self, patterns=(), ignore_file=None):
+        self.ignore_file = ignore_file
+        self.rules = self._compile(patterns)
+
+    @classmethod
+    def from_file(cls, filename, ignore_file=None):
+        """ Read the rules of an ignore file. """
+        with open(filename, 'rU') as f:
+            return cls(f.read().splitlines(), ignore_file)
+
+    def add(self, patterns):
+        """ Add rules after the existing ones. """
+        self.rules = self.rules + self._compile(patterns)
+
+    @staticmethod
+    def _compile(patterns, base=u''):
+        """ Return a tuple of rules (base, match, negated, dir_only). """
+        if isinstance(patterns, basestring):
+            patterns = patterns.splitlines()
+        rules = []
+        for line in patterns:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            # Trailing spaces are dropped unless escaped.
+            stripped = line.rstrip(' ')
+            if stripped.endswith('\\') and len(stripped) < len(line):
+                stripped += ' '
+            line = stripped
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            if '/' in line:
+                regex = _gitignore_regex(line.lstrip('/'))
+            else:
+                regex = '(?:.*/)?' + _gitignore_regex(line)
+            match = re.compile('(?s)%s\\Z' % regex).match
+            rules.append((base, match, negated, dir_only))
+        return tuple(rules)
+
+    @staticmethod
+    def _ignored(rules, rel, isdir):
+        """ Tell if the rules ignore the '/' separated relative path. """
+        for base, match, negated, dir_only in reversed(rules):
+            if dir_only and not isdir:
+                continue
+            if base:
+                if not rel.startswith(base):
+                    continue
+                if match(rel, len(base)):
+                    return not negated
+            elif match(rel):
+                return not negated
+        return False
+
+    def _enter(self, rules, directory, rel, entries):
+        """ Return the rules for the entries of a directory, adding
+        those of its ignore file, if it has one.
+        """
+        name = self.ignore_file
+        if name is None or not any(e.name == name for e in entries):
+            return rules
+        try:
+            with open(os.path.join(directory, name), 'rU') as f:
+                lines = f.read().splitlines()
+        except IOError:
+            return rules
+        return rules + self._compile(lines, rel + u'/' if rel else u'')
+
+    def ignored(self, rel, isdir=False):
+        """ Tell if the rules ignore a path, relative to the directory
+        they apply to.  A path inside an ignored directory is ignored.
+        Ignore files are not read.
+        """
+        parts = rel.replace(os.sep, '/').strip('/').split('/')
+        for i in range(1, len(parts) + 1):
+            if self._ignored(self.rules, '/'.join(parts[:i]),
+                             isdir or i < len(parts)):
+                return True
+        return False
+
+def _glob(directory, components, entries=None):
+    """
+    The engine of path.iglob(): yield the paths below 'directory' (a
+    path object) matching the pattern 'components'.  'entries' is the
+    listing of 'directory' when the caller already has it.
+    """
+    component, rest = components[0], components[1:]
+
+    if not glob.has_magic(component):
+        child = directory / component
+        if not rest:
+            if os.path.lexists(child):
+                yield child
+        elif os.path.isdir(child):
+            for found in _glob(child, rest):
+                yield found
+        return
+
+    if entries is None:
+        try:
+            entries = _scandir(directory or os.curdir)
+        except OSError:
+            return
+
+    if component == '**':
+        while rest and rest[0] == '**':
+            rest = rest[1:]
+        if rest:
+            # '**' standing for no directory at all.
+            for found in _glob(directory, rest, entries):
+                yield found
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            child = directory / entry.name
+            if not rest:
+                yield child
+            if entry.is_dir():
+                for found in _glob(child, components):
+                    yield found
+        return
+
+    match = _name_matcher(component)
+    hidden = component.startswith('.')
+    for entry in entries:
+        name = entry.name
+        if match(name) and (hidden or not name.startswith('.')):
+            child = directory / name
+            if not rest:
+                yield child
+            elif entry.is_dir():
+                for found in _glob(child, rest):
+                    yield found
+
+def _scan_dir(directory):
+    """
+    Work item of the parallel walk engine.  List 'directory' and learn
+    the type of every entry, so all the blocking calls happen on the
+    worker thread.  Returns (directory, [(entry, isdir, error)], error)
+    where the errors are sys.exc_info() tuples or None.
+    """
+    try:
+        entries = _scandir(directory)
+    except Exception:
+        return directory, None, sys.exc_info()
+
+    listing = []
+    for entry in entries:
+        try:
+            isdir = entry.is_dir()
+            if not isdir:
+                # Warm the entry's cache for walkfiles_parallel().
+                entry.is_file()
+        except Exception:
+            listing.append((entry, False, sys.exc_info()))
+        else:
+            listing.append((entry, isdir, None))
+    return directory, listing, None
+
+_libc_handle = []
+
+def _libc():
+    """ Return the C library loaded through ctypes, or None. """
+    if not _libc_handle:
+        # On POSIX the C library is already loaded in the process, and
+        # find_library() would run ldconfig in a subprocess.
+        if os.name == 'posix':
+            name = None
+        else:
+            name = ctypes.util.find_library('c')
+        try:
+            _libc_handle.append(ctypes.CDLL(name, use_errno=True))
+        except (OSError, TypeError):
+            _libc_handle.append(None)
+    return _libc_handle[0]
+
+class _LibcFunction(object):
+    """
+    A function of the C library, loaded on its first use so that
+    importing this module costs nothing.  It tests false if the C
+    library does not have it.
+    """
+
+    def __init__(self, name, restype, argtypes):
+        self.name = name
+        self.restype = restype
+        self.argtypes = argtypes
+        self._func = []
+
+    def _load(self):
+        if not self._func:
+            libc = _libc()
+            func = getattr(libc, self.name, None) if libc is not None \
+                else None
+            if func is not None:
+                func.restype = self.restype
+                func.argtypes = self.argtypes
+            self._func.append(func)
+        return self._func[0]
+
+    def __nonzero__(self):
+        return self._load() is not None
+
+    def __call__(self, *args):
+        return self._load()(*args)
+
+def _kernel_copier(name):
+    """
+    Return a function (fdst, fsrc, count) -> bytes copied, that calls
+    the 'copy_file_range' or 'sendfile' system call on the current file
+    offsets.  It fails with ENOSYS if the C library does not have it.
+    """
+    if name == 'sendfile' and hasattr(os, 'sendfile'):
+        return lambda fdst, fsrc, count: os.sendfile(fdst, fsrc, None, count)
+
+    if name == 'copy_file_range':
+        func = _LibcFunction(name, ctypes.c_ssize_t, [
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_uint])
+        call = lambda fdst, fsrc, count: func(fsrc, None, fdst, None, count, 0)
+    else:
+        func = _LibcFunction(name, ctypes.c_ssize_t, [
+            ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+        call = lambda fdst, fsrc, count: func(fdst, fsrc, None, count)
+
+    def copier(fdst, fsrc, count):
+        if not func:
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        n = call(fdst, fsrc, count)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return copier
+
+# The in-kernel copy methods still worth trying, best first.  A method
+# is dropped for good once the kernel says it does not implement it.
+_kernel_copiers = [(name, _kernel_copier(name))
+                   for name in ('copy_file_range', 'sendfile')]
+
+# Errors telling a kernel copy method does not apply to a pair of
+# files, so the next one should be tried.
+_COPY_FALLBACK_ERRORS = frozenset(
+    getattr(errno, name) for name in
+    ('ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF')
+    if hasattr(errno, name))
+
+_COPY_CHUNK = 1 << 26
+
+def _copy_fd(fsrc, fdst):
+    """
+    Copy the rest of the file open on 'fsrc' to 'fdst', both plain
+    file descriptors, and return the number of bytes copied.  The data
+    is moved inside the kernel with copy_file_range() or sendfile()
+    when possible, and through a userspace buffer otherwise.
+    """
+    copied = 0
+    for name, copier in list(_kernel_copiers):
+        try:
+            while True:
+                n = copier(fdst, fsrc, _COPY_CHUNK)
+                if not n:
+                    return copied
+                copied += n
+        except OSError, e:
+            if e.errno not in _COPY_FALLBACK_ERRORS:
+                raise
+            if e.errno == errno.ENOSYS and (name, copier) in _kernel_copiers:
+                _kernel_copiers.remove((name, copier))
+    while True:
+        data = os.read(fsrc, _COPY_CHUNK)
+        if not data:
+            return copied
+        while data:
+            n = os.write(fdst, data)
+            copied += n
+            data = data[n:]
+
+class _Dirent(ctypes.Structure):
+    """ struct dirent64 of the GNU C library. """
+    _fields_ = [('d_ino', ctypes.c_uint64),
+                ('d_off', ctypes.c_int64),
+                ('d_reclen', ctypes.c_ushort),
+                ('d_type', ctypes.c_ubyte),
+                ('d_name', ctypes.c_char * 256)]
+
+_DT_UNKNOWN, _DT_DIR = 0, 4
+
+_fdopendir = _LibcFunction('fdopendir', ctypes.c_void_p, [ctypes.c_int])
+_readdir = _LibcFunction('readdir64', ctypes.POINTER(_Dirent),
+                         [ctypes.c_void_p])
+_closedir = _LibcFunction('closedir', ctypes.c_int, [ctypes.c_void_p])
+_unlinkat = _LibcFunction('unlinkat', ctypes.c_int,
+                          [ctypes.c_int, ctypes.c_char_p, ctypes.c_int])
+
+def _have_fd_calls():
+    return sys.platform.startswith('linux') and bool(
+        _fdopendir and _readdir and _closedir and _unlinkat)
+
+def _fs_encode(filename):
+    """ Return a file name as a byte string for the C library. """
+    if isinstance(filename, unicode):
+        return filename.encode(sys.getfilesystemencoding() or 'utf-8')
+    return filename
+
+def _fs_decode(filename):
+    """ Return a byte string file name as unicode, for reporting. """
+    if isinstance(filename, unicode):
+        return filename
+    return filename.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+
+def _ctypes_error(filename=None):
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e), filename)
+
+def _opendir_fd(fd, directory):
+    """ Return a C library DIR for the directory open on 'fd', which
+    it then owns.
+    """
+    handle = _fdopendir(fd)
+    if not handle:
+        e = _ctypes_error(directory)
+        os.close(fd)
+        raise e
+    return handle
+
+def _read_dir(handle, directory):
+    """ Read the (name, d_type) of the entries of a C library DIR, but
+    '.' and '..', with the names as byte strings.
+    """
+    # This loop runs for every entry of every directory walked, so the
+    # function is looked up once and errno reset once: readdir() only
+    # sets it on failure.
+    readdir = _readdir._load()
+    entries = []
+    ctypes.set_errno(0)
+    while True:
+        entry = readdir(handle)
+        if not entry:
+            if ctypes.get_errno():
+                raise _ctypes_error(directory)
+            return entries
+        entry = entry[0]
+        name = entry.d_name
+        if name != '.' and name != '..':
+            entries.append((name, entry.d_type))
+
+def _list_dir(directory):
+    """ List the byte string 'directory' with the C library readdir(),
+    which tells the type of the entries too; see _read_dir().
+    """
+    fd = os.open(directory, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    handle = _opendir_fd(fd, directory)
+    try:
+        return _read_dir(handle, directory)
+    finally:
+        _closedir(handle)
+
+def _clear_dir(directory, errors):
+    """
+    Work item of path.rmtree_fast().  Delete everything in the byte
+    string 'directory' except subdirectories, and return the list of
+    their paths.  The files are unlinked relative to a descriptor of
+    the directory, so their paths are not resolved again, and with
+    the C library readdir() the entry types come from the listing
+    itself, without a stat() call.  The descriptor is closed before
+    returning.  Errors are appended to 'errors' as (path, message).
+    """
+    join = os.path.join
+    subdirs = []
+    if not _have_fd_calls():
+        for name in os.listdir(directory):
+            child = join(directory, name)
+            try:
+                if os.path.isdir(child) and not os.path.islink(child):
+                    subdirs.append(child)
+                else:
+                    os.unlink(child)
+            except OSError, e:
+                errors.append((_fs_decode(child), str(e)))
+        return subdirs
+
+    fd = os.open(directory, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) |
+                 getattr(os, 'O_NOFOLLOW', 0))
+    handle = _opendir_fd(fd, directory)
+    try:
+        # List everything first; removing entries while readdir()
+        # goes on may make it skip others.
+        entries = _read_dir(handle, directory)
+        for name, kind in entries:
+            if kind == _DT_DIR:
+                subdirs.append(join(directory, name))
+            elif _unlinkat(fd, name, 0) < 0:
+                e = ctypes.get_errno()
+                # Linux says EISDIR, POSIX EPERM, when an unknown type
+                # turns out to be a directory.
+                if kind == _DT_UNKNOWN and e in (errno.EISDIR, errno.EPERM) \
+                        and os.path.isdir(join(directory, name)):
+                    subdirs.append(join(directory, name))
+                elif e != errno.ENOENT:
+                    errors.append((_fs_decode(join(directory, name)),
+                                   str(OSError(e, os.strerror(e)))))
+    finally:
+        _closedir(handle)
+    return subdirs
+
+def _check_copy(src, dst):
+    """ Refuse the copies shutil.copyfile() refuses. """
+    if shutil._samefile(src, dst):
+        raise shutil.Error("`%s` and `%s` are the same file" % (src, dst))
+    for fn in (src, dst):
+        try:
+            st = os.stat(fn)
+        except OSError:
+            # File most likely does not exist
+            pass
+        else:
+            if stat.S_ISFIFO(st.st_mode):
+                raise shutil.SpecialFileError("`%s` is a named pipe" % fn)
+
+def _open_fd(filename, flags):
+    """ os.open() a file for copying, in binary mode.  Failures raise
+    IOError, as open() and so shutil.copyfile() do.
+    """
+    try:
+        return os.open(filename, flags | getattr(os, 'O_BINARY', 0), 0666)
+    except OSError, e:
+        raise IOError(e.errno, e.strerror, filename)
+
+# Returned by the visit() of _copy_tree() to copy a subdirectory.
+_CopySubdir = collections.namedtuple('_CopySubdir', 'data')
+
+def _copy_tree(src, dst, visit, run, fail, workers, preserve=True,
+               existing=False, enter=None, data=None):
+    """
+    Copy the directory tree 'src' to 'dst' on a pool of 'workers'
+    threads, for path.copytree(), copy_verified(), sync_to() and
+    snapshot_to().
+
+    'dst' is made first and, as with shutil.copytree(), an error
+    listing 'src' or making 'dst' is raised at once.  With
+    existing=True 'dst' and its subdirectories may already exist.
+    The tree is then walked one directory at a time: each directory
+    is listed and made under 'dst', enter(src_dir, dst_dir, rel,
+    entries, data) returns the context of its entries ('data' itself
+    without enter()), and visit(entry, src_dir, dst_dir, name,
+    context) is called for every entry, 'name' being its path
+    relative to the roots.  visit() returns a _CopySubdir to copy a
+    directory, whose 'data' is passed to enter() for it, a task for
+    run(), or None when it is done with the entry.  The EnvironmentErrors
+    of enter() and visit() are passed to fail(name, src, dst, error)
+    and the walk goes on.
+
+    The tasks are run on the pool and the generator yields the results
+    of run() as they come.  Then, with preserve=True, the stat info of
+    the directories is copied, deepest first, since writing their
+    entries changed their times.
+    """
+    def make(target):
+        try:
+            os.makedirs(target)
+        except OSError, e:
+            if not existing or e.errno != errno.EEXIST:
+                raise
+
+    root_entries = _scandir(src)
+    make(dst)
+    dirs = []
+
+    def tasks():
+        stack = [(src, dst, u'', data)]
+        while stack:
+            src_dir, dst_dir, rel, dir_data = stack.pop()
+            try:
+                if src_dir is src:
+                    entries = root_entries
+                else:
+                    entries = _scandir(src_dir)
+                    make(dst_dir)
+                if enter is None:
+                    context = dir_data
+                else:
+                    context = enter(src_dir, dst_dir, rel, entries, dir_data)
+            except EnvironmentError, e:
+                fail(rel, src_dir, dst_dir, e)
+                continue
+            dirs.append((src_dir, dst_dir, rel))
+            for entry in entries:
+                name = os.path.join(rel, entry.name)
+                try:
+                    task = visit(entry, src_dir, dst_dir, name, context)
+                except EnvironmentError, e:
+                    fail(name, src_dir / entry.name, dst_dir / entry.name, e)
+                    continue
+                if isinstance(task, _CopySubdir):
+                    stack.append((src_dir / entry.name, dst_dir / entry.name,
+                                  name, task.data))
+                elif task is not None:
+                    yield task
+
+    pool = ThreadPool(workers)
+    try:
+        try:
+            for result in pool.imap_unordered(run, tasks()):
+                yield result
+        finally:
+            pool.terminate()
+        if preserve:
+            for src_dir, dst_dir, rel in reversed(dirs):
+                try:
+                    shutil.copystat(src_dir, dst_dir)
+                except OSError, e:
+                    fail(rel, src_dir, dst_dir, e)
+    finally:
+        _stat_changed(dst, tree=True)
+
+def _write_all(fd, data):
+    """ Write all of a string or buffer to a file descriptor. """
+    n = os.write(fd, data)
+    while n < len(data):
+        data = buffer(data, n)
+        n = os.write(fd, data)
+
+def _copy_fd_hashing(fsrc, fdst, m):
+    """
+    Copy the file open on 'fsrc' to 'fdst' through userspace, feeding
+    the hash object 'm' the same buffers, and return the number of
+    bytes copied.  Big files are memory mapped, so their data is not
+    even copied into a string.
+    """
+    size = os.fstat(fsrc).st_size
+    if size >= path.mmap_threshold:
+        data = mmap.mmap(fsrc, 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(0, len(data), _MMAP_CHUNK):
+                chunk = buffer(data, offset, _MMAP_CHUNK)
+                m.update(chunk)
+                _write_all(fdst, chunk)
+            copied = len(data)
+        finally:
+            data.close()
+        # The file may have grown since it was mapped.
+        os.lseek(fsrc, copied, os.SEEK_SET)
+    else:
+        copied = 0
+    chunk_size = _read_size(size)
+    while True:
+        data = os.read(fsrc, chunk_size)
+        if not data:
+            return copied
+        m.update(data)
+        _write_all(fdst, data)
+        copied += len(data)
+
+_posix_fadvise = _LibcFunction(
+    'posix_fadvise', ctypes.c_int,
+    [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+_POSIX_FADV_DONTNEED = 4
+
+def _drop_cache(fd):
+    """ Flush a file and ask the kernel to drop it from the page cache,
+    so that reading it again really reads the disk.
+    """
+    os.fsync(fd)
+    if sys.platform.startswith('linux') and _posix_fadvise:
+        _posix_fadvise(fd, 0, 0, _POSIX_FADV_DONTNEED)
+
+class CopyStats(object):
+    """
+    What a copy operation did: the number of files and bytes copied and
+    the time it took.  str() gives a human readable summary.
+    """
+
+    def __init__(self, files=0, bytes=0, elapsed=0.0):
+        self.files = files
+        self.bytes = bytes
+        self.elapsed = elapsed
+
+    @property
+    def rate(self):
+        """ The throughput, in bytes per second. """
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def add(self, other):
+        """ Add the files and bytes of another CopyStats to this one. """
+        self.files += other.files
+        self.bytes += other.bytes
+
+    def __repr__(self):
+        return '%s(files=%d, bytes=%d, elapsed=%.3f)' % (
+            type(self).__name__, self.files, self.bytes, self.elapsed)
+
+    def __str__(self):
+        return '%d files, %s in %.2fs (%s/s)' % (
+            self.files, get_nice_size(self.bytes), self.elapsed,
+            get_nice_size(int(self.rate)))
+
+class SyncReport(object):
+    """
+    What path.sync_to() did.  'added', 'updated' and 'removed' list the
+    paths, relative to the roots, of the files copied for the first
+    time, copied over an older version and deleted from the
+    destination.  'unchanged' counts the files left alone, 'errors'
+    lists (path, message) tuples and 'stats' is the CopyStats of the
+    copies made.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.updated = []
+        self.removed = []
+        self.unchanged = 0
+        self.errors = []
+        self.stats = CopyStats()
+
+    @property
+    def changed(self):
+        """ True if the destination was modified. """
+        return bool(self.added or self.updated or self.removed)
+
+    def __str__(self):
+        return '%d added, %d updated, %d removed, %d unchanged, ' \
+            '%d errors; %s' % (
+                len(self.added), len(self.updated), len(self.removed),
+                self.unchanged, len(self.errors), self.stats)
+
+UsageTotals = collections.namedtuple('UsageTotals',
+                                     'apparent allocated files')
+
+class DiskUsage(object):
+    """
+    What path.disk_usage() found.  'dirs' maps each directory that was
+    reported on to the UsageTotals of its whole subtree: the apparent
+    size (the sum of the file sizes), the allocated size (the disk
+    blocks used) and the number of files.  'total' is the UsageTotals
+    of the root and 'errors' lists (path, message) tuples.
+    """
+
+    def __init__(self, root, dirs, errors):
+        self.root = root
+        self.dirs = dirs
+        self.errors = errors
+
+    @property
+    def total(self):
+        return self.dirs[self.root]
+
+    def top(self, n=10, key='allocated'):
+        """ Return the 'n' largest directories as a list of
+        (path, UsageTotals), largest first.  'key' is the UsageTotals
+        field to sort on.
+        """
+        index = UsageTotals._fields.index(key)
+        items = sorted(self.dirs.iteritems(),
+                       key=lambda item: item[1][index], reverse=True)
+        return items[:n]
+
+    def report(self, n=10, key='allocated'):
+        """ Return a table of the 'n' largest directories as a string. """
+        lines = ['%10s %10s %10s  %s' % ('allocated', 'apparent', 'files',
+                                         'directory')]
+        for directory, totals in self.top(n, key):
+            lines.append('%10s %10s %10d  %s' % (
+                get_nice_size(totals.allocated),
+                get_nice_size(totals.apparent), totals.files, directory))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        total = self.total
+        return '%s: %s allocated, %s apparent, %d files' % (
+            self.root, get_nice_size(total.allocated),
+            get_nice_size(total.apparent), total.files)
+
+def _fsync_dir(directory):
+    """ Flush a directory, making renames in it durable. """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # Windows can not open directories, nor needs to.
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _replace(src, dst):
+    """ Rename 'src' over 'dst', atomically where the platform can. """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if os.name != 'nt' or not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+_syncfs = _LibcFunction('syncfs', ctypes.c_int, [ctypes.c_int])
+
+class GroupCommit(object):
+    """
+    Batch the durability cost of many atomic writes.
+
+    Atomic writes (see path.write_bytes()) made by the current thread
+    inside a 'with GroupCommit():' block go to their temporary files
+    as usual, but they are neither flushed to disk nor renamed into
+    place until the block exits.  Then the data of all of them is
+    flushed at once, with one syncfs() per filesystem where the
+    platform has it, the files are renamed into place and every
+    directory involved is flushed once.  So writing a hundred small
+    settings files costs a handful of flushes instead of two hundred.
+
+    Until the block exits readers keep seeing the old files.  If it
+    exits with an exception the new files are thrown away.
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self.pending = []
+
+    @classmethod
+    def current(cls):
+        """ Return the innermost active GroupCommit of this thread. """
+        stack = getattr(cls._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        self._local.__dict__.setdefault('stack', []).append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.stack.remove(self)
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def add(self, temp, target):
+        """ Schedule 'temp', already written and closed, to replace
+        'target' on commit.
+        """
+        self.pending.append((temp, target))
+
+    def commit(self):
+        """ Make all the pending writes durable and visible.  If that
+        fails, the writes not renamed into place yet are thrown away.
+        """
+        pending = self.pending
+        if not pending:
+            return
+        renamed = 0
+        try:
+            if _syncfs:
+                synced = set()
+                for temp, target in pending:
+                    st = os.stat(temp)
+                    if st.st_dev not in synced:
+                        fd = os.open(temp, os.O_RDONLY)
+                        try:
+                            if _syncfs(fd) != 0:
+                                e = ctypes.get_errno()
+                                raise OSError(e, os.strerror(e))
+                        finally:
+                            os.close(fd)
+                        synced.add(st.st_dev)
+            else:
+                for temp, target in pending:
+                    fd = os.open(temp,
+                                 os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            directories = set()
+            for temp, target in pending:
+                _replace(temp, target)
+                renamed += 1
+                _stat_changed(target)
+                directories.add(os.path.dirname(os.path.abspath(target)))
+            for directory in directories:
+                _fsync_dir(directory)
+        except:
+            del pending[:renamed]
+            self.abort()
+            raise
+        self.pending = []
+
+    def abort(self):
+        """ Throw away all the pending writes. """
+        pending, self.pending = self.pending, []
+        for temp, target in pending:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+@contextlib.contextmanager
+def _atomic_writer(target, buffering=-1):
+    """
+    Open a temporary file next to 'target' for writing and, when the
+    with block succeeds, flush it to disk and rename it over 'target'
+    so readers see either the old or the new file, never a partial
+    one.  Inside a GroupCommit the flush and rename are left to it.
+    """
+    directory, name = os.path.split(os.path.abspath(target))
+    while True:
+        temp = os.path.join(directory, '.%s.%s.tmp' % (
+            name, binascii.hexlify(os.urandom(4))))
+        try:
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, 'O_BINARY', 0), 0666)
+            break
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    group = GroupCommit.current()
+    try:
+        with os.fdopen(fd, 'wb', buffering) as f:
+            try:
+                # Keep the permissions of the file being replaced.
+                os.chmod(temp, stat.S_IMODE(os.stat(target).st_mode))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            yield f
+            if group is None:
+                f.flush()
+                os.fsync(f.fileno())
+    except:
+        os.remove(temp)
+        raise
+    if group is None:
+        _replace(temp, target)
+        _fsync_dir(directory)
+        _stat_changed(target)
+    else:
+        group.add(temp, target)
+
+class StatCache(object):
+    """
+    Remember stat() results for a while, to answer repeated queries on
+    the same paths without a system call each.
+
+    While a StatCache is active in a 'with' block, the path methods
+    exists(), isdir(), isfile(), getsize(), getmtime(), getatime(),
+    getctime() and stat() called from the same thread are answered
+    from one stat() per path, reused for 'ttl' seconds.  Failed stat()s
+    are cached too, so exists() on missing paths is cheap as well.
+    The path methods that modify the filesystem (remove(), rename(),
+    the write_*() methods, mkdir(), copyfile(), ...) drop the entries
+    they make stale, but changes made by other means or processes are
+    only seen once an entry expires.
+
+    A StatCache can also be queried directly, without activating it.
+    'hits' and 'misses' count the lookups.
+
+    Example:
+
+        with StatCache(ttl=5):
+            for p in candidates:
+                if p.isfile() and p.getsize() > limit:
+                    ...
+    """
+
+    _local = threading.local()
+
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+
+    @classmethod
+    def current(cls):
+        """ Return the innermost active StatCache of this thread. """
+        stack = getattr(cls._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        self._local.__dict__.setdefault('stack', []).append(self)
+        return self
+
+    def __exit__(self, *_):
+        self._local.stack.remove(self)
+
+    @property
+    def hit_rate(self):
+        """ The fraction of lookups answered from the cache. """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def _lookup(self, filename):
+        """ Return (stat result, None) or (None, OSError). """
+        key = os.path.abspath(filename)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        try:
+            result = os.stat(filename), None
+        except OSError, e:
+            result = None, e
+        self._entries[key] = (now + self.ttl, result)
+        return result
+
+    def stat(self, filename):
+        st, error = self._lookup(filename)
+        if error is not None:
+            raise error
+        return st
+
+    def exists(self, filename):
+        return self._lookup(filename)[0] is not None
+
+    def isdir(self, filename):
+        st = self._lookup(filename)[0]
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def isfile(self, filename):
+        st = self._lookup(filename)[0]
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def getsize(self, filename):
+        return self.stat(filename).st_size
+
+    def getmtime(self, filename):
+        return self.stat(filename).st_mtime
+
+    def getatime(self, filename):
+        return self.stat(filename).st_atime
+
+    def getctime(self, filename):
+        return self.stat(filename).st_ctime
+
+    def invalidate(self, filename, tree=False):
+        """ Forget 'filename' and its parent directory, whose times
+        change with it.  With tree=True also forget everything below
+        'filename'.
+        """
+        key = os.path.abspath(filename)
+        entries = self._entries
+        entries.pop(key, None)
+        entries.pop(os.path.dirname(key), None)
+        if tree:
+            prefix = os.path.join(key, '')
+            for name in [k for k in entries if k.startswith(prefix)]:
+                del entries[name]
+
+    def clear(self):
+        self._entries.clear()
+
+def _cached_query(func):
+    """
+    Make a path query method answer from the active StatCache, if any,
+    through the StatCache method of the same name.
+    """
+    name = func.__name__
+    @functools.wraps(func)
+    def wrapper(self):
+        cache = StatCache.current()
+        if cache is not None:
+            return getattr(cache, name)(self)
+        return func(self)
+    return wrapper
+
+def _lineage(filename):
+    """ Return 'filename' made absolute and all its parent directories. """
+    filename = os.path.abspath(filename)
+    result = [filename]
+    parent = os.path.dirname(filename)
+    while parent != filename:
+        result.append(parent)
+        filename, parent = parent, os.path.dirname(parent)
+    return result
+
+def _stat_changed(*paths, **kwargs):
+    """
+    Tell the active StatCache, if any, that 'paths' were modified;
+    tree=True means whole trees below them may have changed.
+    """
+    cache = StatCache.current()
+    if cache is not None:
+        for p in paths:
+            cache.invalidate(p, kwargs.get('tree', False))
+
 def simple_cache(func):
     """
     Save results for the 'using_module' classmethod.
@@ -117,6 +1438,9 @@ class path(unicode):
     module = os.path
     "The path module to use for path operations."
 
+    mmap_threshold = 1 << 24
+    "Files at least this big are memory mapped instead of read."
+
     @classmethod
     @simple_cache
     def using_module(cls, module):
@@ -399,6 +1723,20 @@ class path(unicode):
             names = fnmatch.filter(names, pattern)
         return [self / child for child in names]
 
+    def _entries(self, pattern=None):
+        """ D._entries() -> List of (path, entry) pairs for this directory.
+
+        The entries carry the file type reported by the directory
+        listing, so testing them does not cost an extra stat() call
+        on most filesystems.
+        """
+        entries = _scandir(self)
+        if pattern is not None:
+            match = _name_matcher(pattern)
+            entries = [e for e in entries if match(e.name)]
+        cls = self._next_class
+        return [(cls(e.path), e) for e in entries]
+
     def dirs(self, pattern=None):
         """ D.dirs() -> List of this directory's subdirectories.
 
@@ -410,7 +1748,7 @@ class path(unicode):
         directories whose names match the given pattern.  For
         example, d.dirs('build-*').
         """
-        return [p for p in self.listdir(pattern) if p.isdir()]
+        return [p for p, entry in self._entries(pattern) if entry.is_dir()]
 
     def files(self, pattern=None):
         """ D.files() -> List of the files in this directory.
@@ -423,63 +1761,230 @@ class path(unicode):
         d.files('*.pyc').
         """
 
-        return [p for p in self.listdir(pattern) if p.isfile()]
-
-    def walk(self, pattern=None, errors='strict'):
-        """ D.walk() -> iterator over files and subdirs, recursively.
-
-        The iterator yields path objects naming each child item of
-        this directory and its descendants.  This requires that
-        D.isdir().
+        return [p for p, entry in self._entries(pattern) if entry.is_file()]
 
-        This performs a depth-first traversal of the directory tree.
-        Each directory is returned just before all its children.
+    def _walk_entries(self, errors='strict'):
+        """ D._walk_entries() -> iterator over (path, entry, isdir).
 
-        The errors= keyword argument controls behavior when an
-        error occurs.  The default is 'strict', which causes an
-        exception.  The other allowed values are 'warn', which
-        reports the error via warnings.warn(), and 'ignore'.
+        This is the traversal engine behind walk(), walkdirs() and
+        walkfiles().  It visits the tree depth-first, yielding each
+        directory just before its children, and lists every directory
+        with scandir() so the type of a child comes from the directory
+        entry instead of a separate stat() call.  A directory is only
+        listed after it has been yielded, and recursion is done with an
+        explicit stack instead of nested generators.
         """
         if errors not in ('strict', 'warn', 'ignore'):
             raise ValueError("invalid errors parameter")
 
         try:
-            childList = self.listdir()
+            entries = _scandir(self)
         except Exception:
-            if errors == 'ignore':
-                return
-            elif errors == 'warn':
-                warnings.warn(
-                    "Unable to list directory '%s': %s"
-                    % (self, sys.exc_info()[1]),
-                    TreeWalkWarning)
-                return
-            else:
-                raise
+            _walk_error(errors, "Unable to list directory '%s': %s", self)
+            return
 
-        for child in childList:
-            if pattern is None or child.fnmatch(pattern):
-                yield child
-            try:
-                isdir = child.isdir()
-            except Exception:
-                if errors == 'ignore':
-                    isdir = False
-                elif errors == 'warn':
-                    warnings.warn(
-                        "Unable to access '%s': %s"
-                        % (child, sys.exc_info()[1]),
-                        TreeWalkWarning)
+        cls = self._next_class
+        stack = [iter(entries)]
+        while stack:
+            for entry in stack[-1]:
+                child = cls(entry.path)
+                try:
+                    isdir = entry.is_dir()
+                except Exception:
+                    _walk_error(errors, "Unable to access '%s': %s", child)
                     isdir = False
-                else:
-                    raise
 
-            if isdir:
-                for item in child.walk(pattern, errors):
-                    yield item
+                yield child, entry, isdir
 
-    def walkdirs(self, pattern=None, errors='strict'):
-        """ D.walkdirs() -> iterator over subdirs, recursively.
+                if isdir:
+                    try:
+                        entries = _scandir(child)
+                    except Exception:
+                        _walk_error(
+                            errors, "Unable to list directory '%s': %s", child)
+                    else:
+                        stack.append(iter(entries))
+                        break
+            else:
+                stack.pop()
+
+    def _walk_entries_pruned(self, ignore, errors='strict'):
+        """ D._walk_entries_pruned(ignore) -> iterator over (path, entry, isdir).
+
+        The same as D._walk_entries(), but the entries ignored by the
+        IgnoreRules 'ignore' are skipped, and ignored directories are
+        never listed.
+        """
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
+
+        try:
+            entries = _scandir(self)
+        except Exception:
+            _walk_error(errors, "Unable to list directory '%s': %s", self)
+            return
+
+        cls = self._next_class
+        ignored = ignore._ignored
+        stack = [(iter(entries), u'',
+                  ignore._enter(ignore.rules, self, u'', entries))]
+        while stack:
+            children, prefix, rules = stack[-1]
+            for entry in children:
+                rel = prefix + entry.name
+                child = cls(entry.path)
+                try:
+                    isdir = entry.is_dir()
+                except Exception:
+                    _walk_error(errors, "Unable to access '%s': %s", child)
+                    isdir = False
+
+                if rules and ignored(rules, rel, isdir):
+                    continue
+                yield child, entry, isdir
+
+                if isdir:
+                    try:
+                        entries = _scandir(child)
+                    except Exception:
+                        _walk_error(
+                            errors, "Unable to list directory '%s': %s", child)
+                    else:
+                        stack.append((iter(entries), rel + u'/', ignore._enter(
+                            rules, child, rel, entries)))
+                        break
+            else:
+                stack.pop()
+
+    def _walker(self, errors, ignore):
+        """ Return the walk engine for 'ignore', which may be None, an
+        IgnoreRules or a list of rules.
+        """
+        if ignore is None:
+            return self._walk_entries(errors)
+        if not isinstance(ignore, IgnoreRules):
+            ignore = IgnoreRules(ignore)
+        return self._walk_entries_pruned(ignore, errors)
+
+    def _walk_entries_parallel(self, errors='strict', workers=8,
+                               ordered=False, ignore=None):
+        """ D._walk_entries_parallel() -> iterator over (path, entry, isdir).
+
+        The same as D._walk_entries(), but directories are listed on a
+        pool of 'workers' threads.  As soon as a directory has been
+        listed all its subdirectories are queued, so on filesystems with
+        a high latency per call (NFS, FUSE) many listings are in flight
+        at once.
+
+        By default children are yielded as soon as the listing of their
+        directory arrives, so the order is not predictable, although a
+        directory is still yielded before its children.  With
+        ordered=True the items come in exactly the same order as
+        D._walk_entries(); subdirectories are still listed ahead of
+        time, but their results are held back until their turn comes.
+
+        With an IgnoreRules (or a list of rules) as 'ignore', ignored
+        entries are skipped and ignored directories never listed.
+        """
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if ignore is not None and not isinstance(ignore, IgnoreRules):
+            ignore = IgnoreRules(ignore)
+
+        cls = self._next_class
+        pool = ThreadPool(workers)
+        # directory being listed -> (relative path prefix, rules)
+        contexts = {self: (u'', ignore.rules if ignore else ())}
+
+        def receive(result):
+            """ Check one listing for errors, return its children. """
+            directory, listing, error = result
+            prefix, rules = contexts.pop(directory)
+            if error is not None:
+                _walk_error(errors, "Unable to list directory '%s': %s",
+                            directory, error)
+                return []
+            if ignore is not None:
+                rules = ignore._enter(rules, directory, prefix[:-1],
+                                      [entry for entry, _, _ in listing])
+            children = []
+            for entry, isdir, error in listing:
+                child = cls(entry.path)
+                if error is not None:
+                    _walk_error(errors, "Unable to access '%s': %s",
+                                child, error)
+                rel = prefix + entry.name
+                if rules and ignore._ignored(rules, rel, isdir):
+                    continue
+                if isdir:
+                    contexts[child] = (rel + u'/', rules)
+                children.append((child, entry, isdir))
+            return children
+
+        try:
+            if ordered:
+                pending = {}
+
+                def children_of(directory):
+                    children = receive(pending.pop(directory).get())
+                    for child, entry, isdir in children:
+                        if isdir:
+                            pending[child] = pool.apply_async(
+                                _scan_dir, (child,))
+                    return iter(children)
+
+                pending[self] = pool.apply_async(_scan_dir, (self,))
+                stack = [children_of(self)]
+                while stack:
+                    for child, entry, isdir in stack[-1]:
+                        yield child, entry, isdir
+                        if isdir:
+                            stack.append(children_of(child))
+                            break
+                    else:
+                        stack.pop()
+            else:
+                results = Queue.Queue()
+                pool.apply_async(_scan_dir, (self,), callback=results.put)
+                pending = 1
+                while pending:
+                    children = receive(results.get())
+                    pending -= 1
+                    for child, entry, isdir in children:
+                        yield child, entry, isdir
+                        if isdir:
+                            pool.apply_async(_scan_dir, (child,),
+                                             callback=results.put)
+                            pending += 1
+        finally:
+            pool.terminate()
+
+    def walk(self, pattern=None, errors='strict', ignore=None):
+        """ D.walk() -> iterator over files and subdirs, recursively.
+
+        The iterator yields path objects naming each child item of
+        this directory and its descendants.  This requires that
+        D.isdir().
+
+        This performs a depth-first traversal of the directory tree.
+        Each directory is returned just before all its children.
+
+        The errors= keyword argument controls behavior when an
+        error occurs.  The default is 'strict', which causes an
+        exception.  The other allowed values are 'warn', which
+        reports the error via warnings.warn(), and 'ignore'.
+
+        The ignore= keyword argument takes an IgnoreRules, or a list of
+        .gitignore style rules, of entries to leave out.  Ignored
+        directories are not even listed, so their subtrees cost
+        nothing.
+        """
+        return _walk_select(self._walker(errors, ignore), pattern, errors)
+
+    def walkdirs(self, pattern=None, errors='strict', ignore=None):
+        """ D.walkdirs() -> iterator over subdirs, recursively.
 
         With the optional 'pattern' argument, this yields only
         directories whose names match the given pattern.  For
@@ -490,77 +1995,57 @@ class path(unicode):
         error occurs.  The default is 'strict', which causes an
         exception.  The other allowed values are 'warn', which
         reports the error via warnings.warn(), and 'ignore'.
-        """
-        if errors not in ('strict', 'warn', 'ignore'):
-            raise ValueError("invalid errors parameter")
 
-        try:
-            dirs = self.dirs()
-        except Exception:
-            if errors == 'ignore':
-                return
-            elif errors == 'warn':
-                warnings.warn(
-                    "Unable to list directory '%s': %s"
-                    % (self, sys.exc_info()[1]),
-                    TreeWalkWarning)
-                return
-            else:
-                raise
-
-        for child in dirs:
-            if pattern is None or child.fnmatch(pattern):
-                yield child
-            for subsubdir in child.walkdirs(pattern, errors):
-                yield subsubdir
+        The ignore= keyword argument works as for D.walk().
+        """
+        return _walk_select(
+            self._walker(errors, ignore), pattern, errors, 'dirs')
 
-    def walkfiles(self, pattern=None, errors='strict'):
+    def walkfiles(self, pattern=None, errors='strict', ignore=None):
         """ D.walkfiles() -> iterator over files in D, recursively.
 
         The optional argument, pattern, limits the results to files
         with names that match the pattern.  For example,
         mydir.walkfiles('*.tmp') yields only files with the .tmp
-        extension.
+        extension.  The ignore= keyword argument works as for D.walk().
         """
-        if errors not in ('strict', 'warn', 'ignore'):
-            raise ValueError("invalid errors parameter")
+        return _walk_select(
+            self._walker(errors, ignore), pattern, errors, 'files')
+
+    def walk_parallel(self, pattern=None, errors='strict', workers=8,
+                      ordered=False, ignore=None):
+        """ D.walk_parallel() -> iterator over files and subdirs, recursively.
+
+        Like D.walk(), but directories are listed concurrently on a pool
+        of 'workers' threads, which hides the round trip latency of
+        network and FUSE filesystems.  Results are streamed as the
+        listings complete, so their order is unpredictable; pass
+        ordered=True to get exactly the order of D.walk().  The ignore=
+        keyword argument works as for D.walk().
+        """
+        return _walk_select(
+            self._walk_entries_parallel(errors, workers, ordered, ignore),
+            pattern, errors)
 
-        try:
-            childList = self.listdir()
-        except Exception:
-            if errors == 'ignore':
-                return
-            elif errors == 'warn':
-                warnings.warn(
-                    "Unable to list directory '%s': %s"
-                    % (self, sys.exc_info()[1]),
-                    TreeWalkWarning)
-                return
-            else:
-                raise
+    def walkdirs_parallel(self, pattern=None, errors='strict', workers=8,
+                          ordered=False, ignore=None):
+        """ D.walkdirs_parallel() -> iterator over subdirs, recursively.
 
-        for child in childList:
-            try:
-                isfile = child.isfile()
-                isdir = not isfile and child.isdir()
-            except:
-                if errors == 'ignore':
-                    continue
-                elif errors == 'warn':
-                    warnings.warn(
-                        "Unable to access '%s': %s"
-                        % (self, sys.exc_info()[1]),
-                        TreeWalkWarning)
-                    continue
-                else:
-                    raise
+        The parallel version of D.walkdirs(); see D.walk_parallel().
+        """
+        return _walk_select(
+            self._walk_entries_parallel(errors, workers, ordered, ignore),
+            pattern, errors, 'dirs')
+
+    def walkfiles_parallel(self, pattern=None, errors='strict', workers=8,
+                           ordered=False, ignore=None):
+        """ D.walkfiles_parallel() -> iterator over files in D, recursively.
 
-            if isfile:
-                if pattern is None or child.fnmatch(pattern):
-                    yield child
-            elif isdir:
-                for f in child.walkfiles(pattern, errors):
-                    yield f
+        The parallel version of D.walkfiles(); see D.walk_parallel().
+        """
+        return _walk_select(
+            self._walk_entries_parallel(errors, workers, ordered, ignore),
+            pattern, errors, 'files')
 
     def fnmatch(self, pattern):
         """ Return True if self.name matches the given pattern.
@@ -568,7 +2053,7 @@ class path(unicode):
         pattern - A filename pattern with wildcards,
             for example '*.py'.
         """
-        return fnmatch.fnmatch(self.name, pattern)
+        return _name_matcher(pattern)(self.name) is not None
 
     def glob(self, pattern):
         """ Return a list of path objects that match the pattern.
@@ -577,33 +2062,230 @@ class path(unicode):
 
         For example, path('/users').glob('*/bin/*') returns a list
         of all the files users have in their bin directories.
+
+        See path.iglob() for the supported syntax.
         """
-        cls = self._next_class
-        return [cls(s) for s in glob.glob(self / pattern)]
+        return list(self.iglob(pattern))
+
+    def iglob(self, pattern):
+        """ Iterate over the path objects that match the pattern.
+
+        pattern - a path relative to this directory, with wildcards.
+            Besides the wildcards of glob.glob(), a '**' component
+            matches any number of directories, including none, so
+            d.iglob('logs/**/2026-*/*.gz') finds the .gz files in
+            every 2026-* directory anywhere below d/logs.  As with
+            glob.glob(), wildcards do not match names starting with a
+            dot unless the pattern component itself starts with one.
+
+        Each pattern component is compiled once.  Components without
+        wildcards are joined to the path instead of being searched
+        for, so only the directories that can still match the pattern
+        are ever listed, and every directory is listed at most once.
+        Results are yielded as they are found.
+        """
+        parts = (self / pattern).splitall()
+        return _glob(parts[0], parts[1:])
+
+    def grep(self, regex, pattern=None, workers=None, errors='warn',
+             ignore=None, binary=False):
+        """ Search the contents of the files in this tree.
+
+        'regex' is a regular expression, as a string or a compiled
+        pattern, searched in the raw bytes of the files with '^' and
+        '$' matching at every line; a unicode regular expression is
+        encoded to UTF-8.  'pattern' and
+        'ignore' select the files as for walkfiles(); when this is a
+        file, only it is searched.  Files that look binary, having a
+        NUL byte among their first 8 KiB, are skipped unless
+        binary=True.
+
+        The files are memory mapped and searched on a pool of
+        'workers' processes, by default one per CPU (1 means in this
+        process).  The generator yields (path, line_no, line) for each
+        line with a match, line being a byte string without its line
+        end, as soon as it is found; the files come in no particular
+        order, but the lines of a file in order.
+
+        errors - What to do with a file that can not be read: 'warn'
+            (the default) issues a TreeWalkWarning, 'ignore' skips it
+            and 'strict' raises the error.  It also applies to the walk.
+        """
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if isinstance(regex, basestring):
+            source, flags = regex, 0
+        else:
+            source, flags = regex.pattern, regex.flags
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+            flags &= ~re.UNICODE
+        # '^' and '$' match at the start and end of every line.
+        flags |= re.MULTILINE
+
+        if self.isfile():
+            files = [self]
+        else:
+            files = self.walkfiles(pattern, errors, ignore)
+
+        def fail(filename, error):
+            if errors == 'strict':
+                raise error
+            elif errors == 'warn':
+                warnings.warn("Unable to search '%s': %s" % (
+                    filename, error), TreeWalkWarning)
+
+        if workers == 1:
+            for f in files:
+                try:
+                    for line_no, line in _grep_lines(f, source, flags,
+                                                     binary):
+                        yield f, line_no, line
+                except Exception, e:
+                    fail(f, e)
+            return
+
+        # The workers put every line on the queue as soon as they find
+        # it, and a last item with line_no None when a file is done.
+        queue = multiprocessing.Queue()
+        pool = multiprocessing.Pool(workers, _grep_init, (queue,))
+        pending = [0]
+
+        def results(block):
+            while pending[0]:
+                try:
+                    # Wait in steps so the thread stays interruptible.
+                    filename, line_no, line, error = queue.get(block, 0.1)
+                except Queue.Empty:
+                    if block:
+                        continue
+                    return
+                if line_no is not None:
+                    yield filename, line_no, line
+                else:
+                    pending[0] -= 1
+                    if error is not None:
+                        fail(filename, error)
+
+        try:
+            for f in files:
+                pool.apply_async(_grep_file, ((f, source, flags, binary),))
+                pending[0] += 1
+                for result in results(False):
+                    yield result
+            for result in results(True):
+                yield result
+        finally:
+            pool.terminate()
 
     #
     # --- Reading or writing an entire file at once.
 
     def open(self, mode='r'):
         """ Open this file.  Return a file object. """
-        return open(self, mode)
+        f = open(self, mode)
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            _stat_changed(self)
+        return f
+
+    def open_stream(self, mode='rb', compression='auto', level=None):
+        """ Open this file, compressing or decompressing on the fly.
+
+        'mode' is 'rb', 'wb' or 'ab'.  'compression' is 'gzip', 'bz2',
+        'xz' (if the lzma module is available), None for an ordinary
+        file, or 'auto': when reading the format is told from the
+        first bytes of the file, when writing from the extension of
+        its name ('.gz', '.bz2', '.xz', ...).  'level' is the
+        compression level for writing, the library default if None.
+
+        The data is streamed, so only a buffer of it is in memory at a
+        time.  Returns a file object.
+        """
+        if mode not in ('rb', 'wb', 'ab'):
+            raise ValueError("invalid mode: %r" % mode)
+        if compression == 'auto':
+            compression = None
+            if mode == 'rb':
+                with self.open('rb') as f:
+                    start = f.read(6)
+                for name, (exts, magic, opener) in _COMPRESSIONS.iteritems():
+                    if start.startswith(magic):
+                        compression = name
+            else:
+                ext = self.ext.lower()
+                for name, (exts, magic, opener) in _COMPRESSIONS.iteritems():
+                    if ext in exts:
+                        compression = name
+        if compression is None:
+            if mode != 'rb':
+                _stat_changed(self)
+            return self.open(mode)
+        if compression not in _COMPRESSIONS:
+            raise ValueError("unknown compression: %r" % compression)
+        if mode != 'rb':
+            _stat_changed(self)
+        return _COMPRESSIONS[compression][2](self, mode, level)
 
     def bytes(self):
         """ Open this file, read all bytes, return them as a string. """
         with self.open('rb') as f:
             return f.read()
 
-    def write_bytes(self, bytes, append=False):
+    @contextlib.contextmanager
+    def mmap(self, mode='r'):
+        """ Map this file into memory, for use in a with statement.
+
+        The mapping supports the buffer interface, slicing, find() and
+        regular expression searches, so the file can be processed
+        without copying it into a string first.  An empty file, which
+        can not be mapped, gives an empty string.
+
+        mode - 'r' for a read-only mapping, 'r+' for a writable mapping
+            whose changes go to the file, or 'c' for a copy-on-write
+            mapping whose changes are private.
+        """
+        try:
+            access = _MMAP_ACCESS[mode]
+        except KeyError:
+            raise ValueError("invalid mmap mode %r" % (mode,))
+        with self.open('r+b' if mode == 'r+' else 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield ''
+                return
+            m = mmap.mmap(f.fileno(), 0, access=access)
+            try:
+                yield m
+            finally:
+                m.close()
+                if mode == 'r+':
+                    _stat_changed(self)
+
+    def _writer(self, append=False, atomic=False, buffering=-1):
+        """ Open this file for one of the write_*() methods. """
+        _stat_changed(self)
+        if atomic:
+            if append:
+                raise ValueError("atomic writes can not append")
+            return _atomic_writer(self, buffering)
+        return open(self, 'ab' if append else 'wb', buffering)
+
+    def write_bytes(self, bytes, append=False, atomic=False):
         """ Open this file and write the given bytes to it.
 
         Default behavior is to overwrite any existing file.
         Call p.write_bytes(bytes, append=True) to append instead.
+
+        With atomic=True the bytes are written to a temporary file in
+        the same directory, which is flushed to disk and then renamed
+        over this one, so a crash never leaves a partially written
+        file behind.  See GroupCommit to batch the flushes of many
+        atomic writes.
         """
-        if append:
-            mode = 'ab'
-        else:
-            mode = 'wb'
-        with self.open(mode) as f:
+        with self._writer(append, atomic) as f:
             f.write(bytes)
 
     def text(self, encoding=None, errors='strict'):
@@ -631,13 +2313,10 @@ class path(unicode):
                 # (Note - Can't use 'U' mode here, since codecs.open
                 # doesn't support 'U' mode.)
                 t = f.read()
-            return (t.replace(u'\r\n', u'\n')
-                     .replace(u'\r\x85', u'\n')
-                     .replace(u'\r', u'\n')
-                     .replace(u'\x85', u'\n')
-                     .replace(u'\u2028', u'\n'))
+            return _UNICODE_NEWLINE.sub(u'\n', t)
 
-    def write_text(self, text, encoding=None, errors='strict', linesep=os.linesep, append=False):
+    def write_text(self, text, encoding=None, errors='strict', linesep=os.linesep, append=False,
+                   atomic=False):
         r""" Write the given text to this file.
 
         The default behavior is to overwrite any existing file;
@@ -668,6 +2347,9 @@ class path(unicode):
             the file already exists (True: append to the end of it;
             False: overwrite it.)  The default is False.
 
+          - atomic - keyword argument - bool - Replace the file
+            atomically; see path.write_bytes().  The default is False.
+
 
         --- Newline handling.
 
@@ -704,13 +2386,8 @@ class path(unicode):
         if isinstance(text, unicode):
             if linesep is not None:
                 # Convert all standard end-of-line sequences to
-                # ordinary newline characters.
-                text = (text.replace(u'\r\n', u'\n')
-                            .replace(u'\r\x85', u'\n')
-                            .replace(u'\r', u'\n')
-                            .replace(u'\x85', u'\n')
-                            .replace(u'\u2028', u'\n'))
-                text = text.replace(u'\n', linesep)
+                # linesep in a single pass.
+                text = _UNICODE_NEWLINE.sub(linesep.replace('\\', r'\\'), text)
             if encoding is None:
                 encoding = sys.getdefaultencoding()
             bytes = text.encode(encoding, errors)
@@ -720,13 +2397,12 @@ class path(unicode):
             assert encoding is None
 
             if linesep is not None:
-                text = (text.replace('\r\n', '\n')
-                            .replace('\r', '\n'))
-                bytes = text.replace('\n', linesep)
+                bytes = _NEWLINE.sub(linesep.replace('\\', r'\\'), text)
 
-        self.write_bytes(bytes, append)
+        self.write_bytes(bytes, append, atomic)
 
-    def lines(self, encoding=None, errors='strict', retain=True):
+    def lines(self, encoding=None, errors='strict', retain=True,
+              compression=None):
         r""" Open this file, read all lines, return them in a list.
 
         Optional arguments:
@@ -740,17 +2416,89 @@ class path(unicode):
                 character combinations ('\r', '\n', '\r\n') are
                 translated to '\n'.  If false, newline characters are
                 stripped off.  Default is True.
+            compression - Decompress the file while reading it; see
+                path.open_stream() for the values.  Default is None,
+                read the file as it is.
 
-        This uses 'U' mode.
+        See path.iter_lines() to go through a big file without loading
+        all of it.
         """
-        if encoding is None and retain:
-            with self.open('U') as f:
-                return f.readlines()
+        return list(self.iter_lines(encoding, errors, retain,
+                                    compression=compression))
+
+    def iter_lines(self, encoding=None, errors='strict', retain=True,
+                   chunk_size=65536, compression=None):
+        r""" Iterate over the lines of this file.
+
+        This gives the same lines as path.lines(), but the file is read
+        and decoded incrementally, 'chunk_size' bytes at a time, so only
+        the current chunk and line are held in memory.
+
+        encoding - The Unicode encoding of the file, or None (the
+            default) to yield 8-bit str objects.
+
+        errors - How to handle Unicode errors; see help(str.decode).
+
+        retain - If true (the default), keep the end of each line, but
+            translate all the standard newline sequences ('\r', '\n',
+            '\r\n', and for Unicode u'\x85', u'\r\x85', u'\u2028') to
+            '\n'.  If false, strip them off.
+
+        compression - Decompress the file while reading it, as
+            path.open_stream() does.  With 'auto' a gzip, bz2 or xz
+            file is recognized by its first bytes.  The default, None,
+            reads the file as it is.
+        """
+        if encoding is None:
+            decode = None
+            line_break, empty, cr = _NEWLINE, '', '\r'
         else:
-            return self.text(encoding, errors).splitlines(retain)
+            decode = codecs.getincrementaldecoder(encoding)(errors).decode
+            line_break, empty, cr = _UNICODE_LINE_BREAK, u'', u'\r'
+
+        # 'parts' collects the pieces of a line longer than a chunk, and
+        # 'carry' a '\r' that ended a chunk: it may be the start of a
+        # two character sequence that continues in the next one.
+        parts = []
+        carry = empty
+        with self.open_stream('rb', compression) as f:
+            while True:
+                raw = f.read(chunk_size)
+                data = raw if decode is None else decode(raw, not raw)
+                if carry:
+                    data = carry + data
+                    carry = empty
+
+                start = 0
+                end = len(data)
+                for m in line_break.finditer(data):
+                    if raw and m.end() == end and m.group() == cr:
+                        carry = cr
+                        end = m.start()
+                        break
+                    line = data[start:m.start()]
+                    if parts:
+                        parts.append(line)
+                        line = empty.join(parts)
+                        parts = []
+                    if retain:
+                        if m.lastindex is None and decode is not None:
+                            line += m.group()
+                        else:
+                            line += '\n'
+                    yield line
+                    start = m.end()
+                if start < end:
+                    parts.append(data[start:end])
+
+                if not raw:
+                    break
+        if parts:
+            yield empty.join(parts)
 
     def write_lines(self, lines, encoding=None, errors='strict',
-                    linesep=os.linesep, append=False):
+                    linesep=os.linesep, append=False, atomic=False,
+                    buffer_size=1 << 16, compression=None, level=None):
         r""" Write the given lines of text to this file.
 
         By default this overwrites any existing file at this path.
@@ -782,12 +2530,27 @@ class path(unicode):
         you specify with the encoding= parameter, the result is
         mixed-encoding data, which can really confuse someone trying
         to read the file later.
+
+        Use atomic=True to replace the file atomically; see
+        path.write_bytes().
+
+        The lines are joined and written 'buffer_size' bytes at a time
+        rather than one write() per line.
+
+        To write a compressed file give 'compression' and optionally
+        its 'level', as for path.open_stream().  Compressed files can
+        not be written atomically.
         """
-        if append:
-            mode = 'ab'
+        if compression is not None:
+            if atomic:
+                raise ValueError("compressed writes can not be atomic")
+            writer = self.open_stream('ab' if append else 'wb',
+                                      compression, level)
         else:
-            mode = 'wb'
-        with self.open(mode) as f:
+            writer = self._writer(append, atomic, buffer_size)
+        with writer as f:
+            chunk = []
+            chunk_size = 0
             for line in lines:
                 isUnicode = isinstance(line, unicode)
                 if linesep is not None:
@@ -809,7 +2572,14 @@ class path(unicode):
                     if encoding is None:
                         encoding = sys.getdefaultencoding()
                     line = line.encode(encoding, errors)
-                f.write(line)
+                chunk.append(line)
+                chunk_size += len(line)
+                if chunk_size >= buffer_size:
+                    f.write(''.join(chunk))
+                    chunk = []
+                    chunk_size = 0
+            if chunk:
+                f.write(''.join(chunk))
 
     def read_md5(self):
         """ Calculate the md5 hash for this file.
@@ -818,61 +2588,127 @@ class path(unicode):
         """
         return self.read_hash('md5')
 
-    def _hash(self, hash_name):
+    def _hashes(self, hash_names):
+        """ Return hash objects of this file, one for each of the given
+        hash names, all fed from a single read of the file.
+        """
+        hashes = [hashlib.new(hash_name) for hash_name in hash_names]
+        updates = [m.update for m in hashes]
         with self.open('rb') as f:
-            m = hashlib.new(hash_name)
+            size = os.fstat(f.fileno()).st_size
+            if size >= self.mmap_threshold:
+                # Feed the hashes straight from the page cache.
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, len(data), _MMAP_CHUNK):
+                        chunk = buffer(data, offset, _MMAP_CHUNK)
+                        for update in updates:
+                            update(chunk)
+                finally:
+                    data.close()
+                return hashes
+            size = _read_size(size)
             while True:
-                d = f.read(8192)
+                d = f.read(size)
                 if not d:
                     break
-                m.update(d)
-            return m
+                for update in updates:
+                    update(d)
+            return hashes
+
+    def _hash(self, hash_name):
+        return self._hashes([hash_name])[0]
 
-    def read_hash(self, hash_name):
+    def read_hash(self, hash_name, cache=None):
         """ Calculate given hash for this file.
 
         List of supported hashes can be obtained from hashlib package. This
-        reads the entire file.
+        reads the entire file, unless a DigestCache is given as 'cache' and
+        it holds a digest for the current version of the file.
         """
+        if cache is not None:
+            return cache.digest(self, hash_name)
         return self._hash(hash_name).digest()
 
-    def read_hexhash(self, hash_name):
+    def read_hexhash(self, hash_name, cache=None):
         """ Calculate given hash for this file, returning hexdigest.
 
         List of supported hashes can be obtained from hashlib package. This
-        reads the entire file.
+        reads the entire file, unless a DigestCache is given as 'cache' and
+        it holds a digest for the current version of the file.
         """
+        if cache is not None:
+            return cache.digest(self, hash_name).encode('hex')
         return self._hash(hash_name).hexdigest()
 
+    def read_hashes(self, hash_names, cache=None):
+        """ Calculate several hashes for this file at once.
+
+        Returns a dict of hash name -> digest.  The file is read only
+        once, whatever the number of hashes, and not at all if a
+        DigestCache is given as 'cache' and it holds all the digests
+        for the current version of the file.
+        """
+        hash_names = list(hash_names)
+        if cache is None:
+            return dict((hash_name, m.digest()) for hash_name, m in
+                        zip(hash_names, self._hashes(hash_names)))
+        st = os.stat(self)
+        digests = {}
+        for hash_name in hash_names:
+            digest = cache.lookup(self, hash_name, st)
+            if digest is not None:
+                digests[hash_name] = digest
+        missing = [name for name in hash_names if name not in digests]
+        if missing:
+            for hash_name, m in zip(missing, self._hashes(missing)):
+                digests[hash_name] = m.digest()
+                cache.store(self, hash_name, digests[hash_name], st)
+        return digests
+
+    def read_hexhashes(self, hash_names, cache=None):
+        """ Calculate several hashes for this file at once, returning
+        a dict of hash name -> hexdigest.  See read_hashes().
+        """
+        return dict((hash_name, digest.encode('hex')) for hash_name, digest
+                    in self.read_hashes(hash_names, cache).iteritems())
+
     # --- Methods for querying the filesystem.
     # N.B. On some platforms, the os.path functions may be implemented in C
     # (e.g. isdir on Windows, Python 3.2.2), and compiled functions don't get
     # bound. Playing it safe and wrapping them all in method calls.
 
     def isabs(self): return self.module.isabs(self)
+    @_cached_query
     def exists(self): return self.module.exists(self)
+    @_cached_query
     def isdir(self): return self.module.isdir(self)
+    @_cached_query
     def isfile(self): return self.module.isfile(self)
     def islink(self): return self.module.islink(self)
     def ismount(self): return self.module.ismount(self)
 
     def samefile(self): return self.module.samefile(self)
 
+    @_cached_query
     def getatime(self): return self.module.getatime(self)
     atime = property(
         getatime, None, None,
         """ Last access time of the file. """)
 
+    @_cached_query
     def getmtime(self): return self.module.getmtime(self)
     mtime = property(
         getmtime, None, None,
         """ Last-modified time of the file. """)
 
+    @_cached_query
     def getctime(self): return self.module.getctime(self)
     ctime = property(
         getctime, None, None,
         """ Creation time of the file. """)
 
+    @_cached_query
     def getsize(self): return self.module.getsize(self)
     size = property(
         getsize, None, None,
@@ -886,6 +2722,7 @@ class path(unicode):
             """
             return os.access(self, mode)
 
+    @_cached_query
     def stat(self):
         """ Perform a stat() system call on this path. """
         return os.stat(self)
@@ -944,23 +2781,29 @@ class path(unicode):
     def utime(self, times):
         """ Set the access and modified times of this file. """
         os.utime(self, times)
+        _stat_changed(self)
         return self
 
     def chmod(self, mode):
         os.chmod(self, mode)
+        _stat_changed(self)
         return self
 
     if hasattr(os, 'chown'):
         def chown(self, uid, gid):
             os.chown(self, uid, gid)
+            _stat_changed(self)
             return self
 
     def rename(self, new):
         os.rename(self, new)
+        _stat_changed(self, new, tree=True)
         return self._next_class(new)
 
     def renames(self, new):
         os.renames(self, new)
+        _stat_changed(self, new, tree=True)
+        _stat_changed(*(_lineage(self) + _lineage(new)))
         return self._next_class(new)
 
     #
@@ -968,6 +2811,7 @@ class path(unicode):
 
     def mkdir(self, mode=0777):
         os.mkdir(self, mode)
+        _stat_changed(self)
         return self
 
     def mkdir_p(self, mode=0777):
@@ -980,6 +2824,7 @@ class path(unicode):
 
     def makedirs(self, mode=0777):
         os.makedirs(self, mode)
+        _stat_changed(*_lineage(self))
         return self
 
     def makedirs_p(self, mode=0777):
@@ -992,6 +2837,7 @@ class path(unicode):
 
     def rmdir(self):
         os.rmdir(self)
+        _stat_changed(self)
         return self
 
     def rmdir_p(self):
@@ -1004,6 +2850,7 @@ class path(unicode):
 
     def removedirs(self):
         os.removedirs(self)
+        _stat_changed(*_lineage(self))
         return self
 
     def removedirs_p(self):
@@ -1023,10 +2870,12 @@ class path(unicode):
         fd = os.open(self, os.O_WRONLY | os.O_CREAT, 0666)
         os.close(fd)
         os.utime(self, None)
+        _stat_changed(self)
         return self
 
     def remove(self):
         os.remove(self)
+        _stat_changed(self)
         return self
 
     def remove_p(self):
@@ -1039,6 +2888,7 @@ class path(unicode):
 
     def unlink(self):
         os.unlink(self)
+        _stat_changed(self)
         return self
 
     def unlink_p(self):
@@ -1051,12 +2901,14 @@ class path(unicode):
         def link(self, newpath):
             """ Create a hard link at 'newpath', pointing to this file. """
             os.link(self, newpath)
+            _stat_changed(self, newpath)
             return self._next_class(newpath)
 
     if hasattr(os, 'symlink'):
         def symlink(self, newlink):
             """ Create a symbolic link at 'newlink', pointing here. """
             os.symlink(self, newlink)
+            _stat_changed(newlink)
             return self._next_class(newlink)
 
     if hasattr(os, 'readlink'):
@@ -1081,15 +2933,634 @@ class path(unicode):
     #
     # --- High-level functions from shutil
 
-    copyfile = shutil.copyfile
     copymode = shutil.copymode
     copystat = shutil.copystat
-    copy = shutil.copy
-    copy2 = shutil.copy2
-    copytree = shutil.copytree
+
+    def copyfile(self, dst, preserve=False):
+        """ Copy the data of this file to 'dst', like shutil.copyfile().
+
+        The data is copied inside the kernel with copy_file_range() or
+        sendfile() where the platform allows it, and through a large
+        userspace buffer otherwise.  With preserve=True the permission
+        bits, times and flags are copied too, as shutil.copystat() does.
+
+        Returns a CopyStats.
+        """
+        start = time.time()
+        _check_copy(self, dst)
+        fsrc = _open_fd(self, os.O_RDONLY)
+        try:
+            fdst = _open_fd(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            try:
+                copied = _copy_fd(fsrc, fdst)
+            finally:
+                os.close(fdst)
+        finally:
+            os.close(fsrc)
+        if preserve:
+            shutil.copystat(self, dst)
+        _stat_changed(dst)
+        return CopyStats(1, copied, time.time() - start)
+
+    def copy(self, dst):
+        """ Copy data and mode bits, like shutil.copy().
+
+        'dst' may be a directory.  Returns a CopyStats.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, self.name)
+        stats = self.copyfile(dst)
+        shutil.copymode(self, dst)
+        return stats
+
+    def copy2(self, dst):
+        """ Copy data and all stat info, like shutil.copy2().
+
+        'dst' may be a directory.  Returns a CopyStats.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, self.name)
+        return self.copyfile(dst, preserve=True)
+
+    def copytree(self, dst, symlinks=False, ignore=None, preserve=True,
+                 workers=8):
+        """ Recursively copy this directory to 'dst', like shutil.copytree().
+
+        'dst' must not exist yet.  'symlinks' and 'ignore' mean the same
+        as for shutil.copytree().  The directories are created as the
+        tree is walked and the files are copied with path.copyfile() on
+        a pool of 'workers' threads, so many copies are in flight at
+        once.  With preserve=True (the default) the stat info of files
+        and directories is copied too.
+
+        Errors are collected and raised together as a shutil.Error once
+        everything else has been copied.  Returns a CopyStats.
+        """
+        start = time.time()
+        stats = CopyStats()
+        errors = []
+
+        def fail(name, src, dst, e):
+            errors.append((src, dst, str(e)))
+
+        def enter(src, target, rel, entries, data):
+            if ignore is None:
+                return ()
+            return ignore(src, [entry.name for entry in entries])
+
+        def visit(entry, src, target, name, ignored):
+            if entry.name in ignored:
+                return None
+            if symlinks and entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target / entry.name)
+            elif entry.is_dir():
+                return _CopySubdir(None)
+            else:
+                return src / entry.name, target / entry.name
+
+        def copy(task):
+            srcname, dstname = task
+            try:
+                return srcname.copyfile(dstname, preserve)
+            except (EnvironmentError, shutil.Error), e:
+                return srcname, dstname, str(e)
+
+        for result in _copy_tree(self, self._next_class(dst), visit, copy,
+                                 fail, workers, preserve, enter=enter):
+            if isinstance(result, CopyStats):
+                stats.add(result)
+            else:
+                errors.append(result)
+        if errors:
+            raise shutil.Error(errors)
+        stats.elapsed = time.time() - start
+        return stats
+
+    def copy_verified(self, dst, hash_name='sha256', verify=False,
+                      preserve=True, workers=8):
+        """ Copy this file or tree, hashing the data as it is copied.
+
+        'hash_name' names the hashlib algorithm, as for read_hash().
+        Every byte is read once: the digest comes from the same
+        buffers that are written to 'dst', so there is no need to hash
+        the source separately.  With verify=True each copy is then
+        flushed, dropped from the page cache where the platform allows,
+        and read back to check that its digest matches.  With
+        preserve=True (the default) the stat info is copied too, as by
+        copy2().
+
+        For a file, 'dst' may be a directory, and the result is a
+        tuple (hexdigest, CopyStats); a failed verification raises an
+        IOError.  For a directory, 'dst' must not exist yet; the
+        files are copied on a pool of 'workers' threads and the result
+        is (digests, CopyStats) with 'digests' a dict of relative path
+        -> hexdigest.  As with copytree(), failing to list this tree
+        or to make 'dst' raises at once; other errors, failed
+        verifications included, are collected and raised together as
+        a shutil.Error at the end.
+        """
+        if self.isdir():
+            return self._copytree_verified(dst, hash_name, verify, preserve,
+                                           workers)
+        start = time.time()
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, self.name)
+        _check_copy(self, dst)
+        m = hashlib.new(hash_name)
+        fsrc = os.open(self, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                           getattr(os, 'O_BINARY', 0), 0666)
+            try:
+                copied = _copy_fd_hashing(fsrc, fdst, m)
+                if verify:
+                    _drop_cache(fdst)
+            finally:
+                os.close(fdst)
+        finally:
+            os.close(fsrc)
+        if preserve:
+            shutil.copystat(self, dst)
+        _stat_changed(dst)
+        digest = m.hexdigest()
+        if verify and self._next_class(dst)._hash(hash_name).hexdigest() != digest:
+            raise IOError(errno.EIO, "verification of the copy failed", dst)
+        return digest, CopyStats(1, copied, time.time() - start)
+
+    def _copytree_verified(self, dst, hash_name, verify, preserve, workers):
+        start = time.time()
+        stats = CopyStats()
+        digests = {}
+        errors = []
+
+        def fail(name, src, dst, e):
+            errors.append((src, dst, str(e)))
+
+        def visit(entry, src, target, name, data):
+            if entry.is_dir():
+                return _CopySubdir(None)
+            return src / entry.name, target / entry.name, name
+
+        def copy(task):
+            srcname, dstname, name = task
+            try:
+                return name, srcname.copy_verified(
+                    dstname, hash_name, verify, preserve)
+            except (EnvironmentError, shutil.Error), e:
+                return name, (srcname, dstname, str(e))
+
+        for name, result in _copy_tree(self, self._next_class(dst), visit,
+                                       copy, fail, workers, preserve):
+            if isinstance(result[1], CopyStats):
+                digests[name] = result[0]
+                stats.add(result[1])
+            else:
+                errors.append(result)
+        if errors:
+            raise shutil.Error(errors)
+        stats.elapsed = time.time() - start
+        return digests, stats
+
+    def sync_to(self, dest, checksum=False, delete=False, workers=8):
+        """ Make the directory 'dest' a mirror of this one, copying only
+        what changed.
+
+        A file is copied when it is missing from 'dest' or its size or
+        modification time differ.  With checksum=True files of the same
+        size are compared by content instead of by time (and only get
+        their times fixed when the content matches).  With delete=True
+        anything in 'dest' that is not in this tree is removed.
+
+        Both trees are listed one directory at a time, so finding out
+        what changed costs no stat() on the destination files, and the
+        copies and content checks run on a pool of 'workers' threads.
+        Copies preserve the stat info, which is what lets the next run
+        see the files as unchanged.
+
+        Returns a SyncReport.  Failing to list this tree or to make
+        'dest' raises at once; other errors do not stop the run, they
+        are collected in its 'errors' list.
+        """
+        start = time.time()
+        report = SyncReport()
+        cls = self._next_class
+        # visit() runs on the pool's task handler thread, so the
+        # counter it shares with the result loop needs a lock.
+        lock = threading.Lock()
+
+        def fail(name, src, dst, e):
+            report.errors.append((cls(name), str(e)))
+
+        def remove(entry):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+        def enter(src, target, rel, entries, data):
+            existing = dict((e.name, e) for e in _scandir(target))
+            if delete:
+                names = set(entry.name for entry in entries)
+                for entry in existing.values():
+                    if entry.name in names:
+                        continue
+                    name = cls(os.path.join(rel, entry.name))
+                    del existing[entry.name]
+                    try:
+                        remove(entry)
+                    except EnvironmentError, e:
+                        fail(name, entry.path, None, e)
+                    else:
+                        report.removed.append(name)
+            return existing
+
+        def visit(entry, src, target, name, existing):
+            name = cls(name)
+            other = existing.pop(entry.name, None)
+            action = 'add'
+            isdir = entry.is_dir()
+            # Nothing under 'dest' is followed: a symbolic link there is
+            # replaced like any other type mismatch, never written through.
+            if other is not None and (
+                    other.is_symlink() or
+                    isdir != other.is_dir(follow_symlinks=False)):
+                remove(other)
+                other = None
+                action = 'update'
+            if isdir:
+                return _CopySubdir(None)
+            if other is None:
+                return action, entry, target / entry.name, name
+            st = entry.stat()
+            other_st = other.stat(follow_symlinks=False)
+            if st.st_size != other_st.st_size:
+                return 'update', entry, other.path, name
+            elif checksum:
+                return 'compare', entry, other.path, name
+            elif abs(st.st_mtime - other_st.st_mtime) > 0.001:
+                return 'update', entry, other.path, name
+            with lock:
+                report.unchanged += 1
+            return None
+
+        def run(task):
+            action, entry, target, name = task
+            src = cls(entry.path)
+            try:
+                if action == 'compare':
+                    if src._hash('sha1').digest() == \
+                            cls(target)._hash('sha1').digest():
+                        shutil.copystat(src, target)
+                        return action, name, None
+                    action = 'update'
+                return action, name, src.copyfile(target, preserve=True)
+            except (EnvironmentError, shutil.Error), e:
+                return action, name, e
+
+        for action, name, result in _copy_tree(
+                self, cls(dest), visit, run, fail, workers, preserve=False,
+                existing=True, enter=enter):
+            if isinstance(result, CopyStats):
+                report.stats.add(result)
+                if action == 'add':
+                    report.added.append(name)
+                else:
+                    report.updated.append(name)
+            elif result is not None:
+                fail(name, None, None, result)
+            else:
+                with lock:
+                    report.unchanged += 1
+        report.stats.elapsed = time.time() - start
+        return report
+
+    def disk_usage(self, depth=None, workers=8, errors='warn'):
+        """ Measure the space used by this directory tree, like du.
+
+        The tree is listed on a pool of 'workers' threads, as by
+        walk_parallel(), and every entry is lstat()ed once.  Symbolic
+        links are not followed and a file with several hard links in
+        the tree is counted only once.
+
+        Totals are kept for the directories at most 'depth' levels
+        below this one (all of them by default); deeper directories
+        are counted in their ancestor at that depth.  'errors' is
+        handled as for walk(); with 'warn' or 'ignore' the entries
+        that could not be stat()ed are also listed, with the reason,
+        in the result's 'errors'.
+
+        Returns a DiskUsage.
+        """
+        failures = []
+        root = self._next_class(os.path.dirname(os.path.join(self, u'')))
+        # directory -> [bucket, depth]; the bucket of a directory is
+        # itself, or its ancestor at 'depth' if it is deeper than that.
+        where = {root: (root, 0)}
+        own = {root: [0, 0, 0]}
+        seen = set()
+        dirname = os.path.dirname
+
+        try:
+            st = os.lstat(root)
+        except OSError, e:
+            _walk_error(errors, "Unable to access '%s': %s", root)
+            failures.append((root, str(e)))
+        else:
+            own[root][0] += st.st_size
+            own[root][1] += getattr(st, 'st_blocks', 0) * 512
+
+        walker = self._walk_entries_parallel(errors, workers)
+        for child, entry, isdir in walker:
+            bucket, level = where[dirname(child)]
+            if isdir:
+                level += 1
+                if depth is None or level <= depth:
+                    bucket = child
+                    own[child] = [0, 0, 0]
+                where[child] = (bucket, level)
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError, e:
+                _walk_error(errors, "Unable to access '%s': %s", child)
+                failures.append((child, str(e)))
+                continue
+            if st.st_nlink > 1 and not isdir:
+                key = (st.st_dev, st.st_ino)
+                if key in seen:
+                    continue
+                seen.add(key)
+            totals = own[bucket]
+            totals[0] += st.st_size
+            totals[1] += getattr(st, 'st_blocks', 0) * 512
+            if not isdir:
+                totals[2] += 1
+
+        # Add every directory to its parent, deepest first.
+        for directory in sorted(own, key=len, reverse=True):
+            if directory != root:
+                parent = own[where[dirname(directory)][0]]
+                for i, value in enumerate(own[directory]):
+                    parent[i] += value
+        dirs = dict((directory, UsageTotals(*totals))
+                    for directory, totals in own.iteritems())
+        return DiskUsage(root, dirs, failures)
+
+    def snapshot_to(self, dest, link_dest=None, checksum=False, workers=8,
+                    manifest='.snapshot-manifest'):
+        """ Take a snapshot of this directory tree in 'dest', hard
+        linking the files that did not change since the snapshot
+        'link_dest', like rsync --link-dest.
+
+        'dest' must not exist yet.  A file is linked from 'link_dest'
+        when it has the same size, mode and modification time there, or
+        with checksum=True the same size, mode and SHA-1 digest; all
+        other files are copied with their stat info.  Symbolic links
+        are recreated, not followed.  So a snapshot costs space and
+        time for what changed only, yet every snapshot is a complete
+        tree.  The links and copies run on a pool of 'workers' threads.
+
+        Unless 'manifest' is None, a file by that name is written at
+        the top of the snapshot, listing for every file its relative
+        path, size and modification time in nanoseconds (of the file in
+        the snapshot), SHA-1 hex digest
+        (with checksum=True, '-' otherwise) and whether it was linked
+        or copied.  The digests of the manifest of 'link_dest' are
+        trusted for its files that still have the size and time listed
+        there, so with checksum=True the previous snapshot is not read
+        again.
+
+        Returns a SyncReport: 'added' and 'updated' list the files
+        copied because they are new or changed, 'unchanged' counts the
+        linked files.  Failing to list this tree or to make 'dest'
+        raises at once; other errors do not stop the snapshot, they
+        are collected in its 'errors' list.
+        """
+        start = time.time()
+        report = SyncReport()
+        cls = self._next_class
+        dest = cls(dest)
+        previous = cls(link_dest) if link_dest is not None else None
+        rows = []
+
+        known = {}
+        if previous is not None and manifest is not None:
+            try:
+                for line in (previous / manifest).iter_lines('utf-8',
+                                                            retain=False):
+                    rel, size, mtime_ns, digest = line.split('\t')[:4]
+                    known[rel] = (int(size), int(mtime_ns), digest)
+            except (EnvironmentError, ValueError):
+                known = {}
+
+        def fail(name, src, dst, e):
+            report.errors.append((name, str(e)))
+
+        def enter(src, target, rel, entries, prev):
+            old = {}
+            if prev is not None:
+                try:
+                    old = dict((e.name, e) for e in _scandir(prev))
+                except OSError:
+                    pass
+            return prev, old
+
+        def visit(entry, src, target, name, context):
+            prev, old = context
+            if name == manifest:
+                return None
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target / entry.name)
+                return None
+            if entry.is_dir():
+                return _CopySubdir(
+                    prev / entry.name if entry.name in old else None)
+            st = entry.stat()
+            other = old.get(entry.name)
+            action = 'add'
+            if other is not None and other.is_file(follow_symlinks=False):
+                other_st = other.stat(follow_symlinks=False)
+                action = 'update'
+                if st.st_size == other_st.st_size and \
+                        st.st_mode == other_st.st_mode:
+                    if checksum:
+                        action = 'compare'
+                    elif abs(st.st_mtime - other_st.st_mtime) <= 0.001:
+                        action = 'link'
+            return (action, cls(entry.path), target / entry.name, other,
+                    name, st)
+
+        def run(task):
+            action, src, target, other, name, st = task
+            digest = '-'
+            try:
+                if action == 'compare':
+                    other_st = other.stat(follow_symlinks=False)
+                    entry = known.get(name)
+                    if entry is not None and entry[2] != '-' and \
+                            entry[:2] == (other_st.st_size,
+                                          _stat_key(other_st)[3]):
+                        other_digest = entry[2]
+                    else:
+                        other_digest = cls(other.path)._hash('sha1') \
+                            .hexdigest()
+                    digest = src._hash('sha1').hexdigest()
+                    action = 'link' if digest == other_digest else 'update'
+                if action == 'link':
+                    try:
+                        os.link(other.path, target)
+                        return action, name, os.stat(target), digest, None
+                    except OSError, e:
+                        # Across devices or too many links: copy.
+                        if e.errno not in (errno.EXDEV, errno.EMLINK):
+                            raise
+                        action = 'update'
+                if checksum:
+                    digest, stats = src.copy_verified(target, 'sha1')
+                else:
+                    stats = src.copyfile(target, preserve=True)
+                # The manifest lists the times of the snapshot's files,
+                # which copystat() may have rounded, so that the next
+                # snapshot can compare them with what it finds here.
+                return action, name, os.stat(target), digest, stats
+            except (EnvironmentError, shutil.Error), e:
+                return action, name, st, digest, e
+
+        for action, name, st, digest, result in _copy_tree(
+                self, dest, visit, run, fail, workers, enter=enter,
+                data=previous):
+            if isinstance(result, Exception):
+                fail(name, None, None, result)
+                continue
+            if result is None:
+                report.unchanged += 1
+            else:
+                report.stats.add(result)
+                if action == 'add':
+                    report.added.append(name)
+                else:
+                    report.updated.append(name)
+            rows.append((name, st.st_size, _stat_key(st)[3], digest,
+                         'linked' if result is None else 'copied'))
+
+        if manifest is not None:
+            rows.sort()
+            try:
+                (dest / manifest).write_lines(
+                    (u'%s\t%d\t%d\t%s\t%s' % row for row in rows),
+                    'utf-8', linesep='\n', atomic=True)
+                shutil.copystat(self, dest)
+            except EnvironmentError, e:
+                fail(manifest, dest / manifest, None, e)
+            _stat_changed(dest)
+        report.stats.elapsed = time.time() - start
+        return report
+
     if hasattr(shutil, 'move'):
-        move = shutil.move
-    rmtree = shutil.rmtree
+        def move(self, dst):
+            """ Recursively move this file or directory, like shutil.move(). """
+            shutil.move(self, dst)
+            _stat_changed(self, dst, tree=True)
+
+    def rmtree(self, ignore_errors=False, onerror=None):
+        """ Delete this directory tree, like shutil.rmtree(). """
+        try:
+            shutil.rmtree(self, ignore_errors, onerror)
+        finally:
+            _stat_changed(self, tree=True)
+
+    def rmtree_fast(self, workers=8):
+        """ Delete this directory tree, like rmtree(), on a pool of
+        'workers' threads.
+
+        Every directory is opened once; the files in it are unlinked
+        relative to the open descriptor, so their paths are not looked
+        up again.  Subdirectories are handed to idle threads, so
+        independent subtrees are deleted at the same time, and a
+        directory is removed as soon as the last of its subtrees is.
+
+        Errors do not stop the deletion; the parts that could not be
+        deleted are left in place and a list of (path, message) is
+        returned, empty when everything was deleted.
+        """
+        errors = []
+        lock = threading.Lock()
+        done = threading.Event()
+        queued = [0]
+        pool = ThreadPool(workers)
+
+        class Node(object):
+            """ A directory waiting for its subtrees. """
+            def __init__(self, path, parent):
+                self.path = path
+                self.parent = parent
+                self.count = 1
+                self.failed = False
+
+        def release(node, failed=False):
+            while node is not None:
+                with lock:
+                    node.failed = node.failed or failed
+                    node.count -= 1
+                    if node.count:
+                        return
+                failed = node.failed
+                if not failed:
+                    try:
+                        os.rmdir(node.path)
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            errors.append((_fs_decode(node.path), str(e)))
+                            failed = True
+                if node.parent is None:
+                    done.set()
+                node = node.parent
+
+        def clear(node):
+            # The subdirectories no idle thread takes are cleared here,
+            # from a stack rather than by recursion, so the depth of
+            # the tree costs neither stack frames nor open descriptors.
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                failures = []
+                try:
+                    subdirs = _clear_dir(node.path, failures)
+                except OSError, e:
+                    subdirs = []
+                    failures.append((_fs_decode(node.path), str(e)))
+                except Exception, e:
+                    subdirs = []
+                    failures.append((_fs_decode(node.path), repr(e)))
+                errors.extend(failures)
+                for child in subdirs:
+                    child = Node(child, node)
+                    with lock:
+                        node.count += 1
+                        handoff = queued[0] < workers
+                        if handoff:
+                            queued[0] += 1
+                    if handoff:
+                        pool.apply_async(run, (child,))
+                    else:
+                        stack.append(child)
+                release(node, bool(failures))
+
+        def run(node):
+            with lock:
+                queued[0] -= 1
+            clear(node)
+
+        try:
+            with lock:
+                queued[0] += 1
+            pool.apply_async(run, (Node(_fs_encode(self), None),))
+            # Wait in steps so the main thread stays interruptible.
+            while not done.wait(0.1):
+                pass
+        finally:
+            pool.terminate()
+            _stat_changed(self, tree=True)
+        return errors
 
     def rmtree_p(self):
         try:
@@ -1099,6 +3570,33 @@ class path(unicode):
                 raise
         return self
 
+    #
+    # --- Watching for changes
+
+    def watch(self, recursive=True, pattern=None, events=None, poll=None,
+              interval=1.0):
+        """ Watch this directory for changes.  Returns a TreeWatcher.
+
+        With recursive=True (the default) the whole tree is watched,
+        including the directories created or moved into it later.
+        'pattern' limits the events to the names matching it, and
+        'events' to the given kinds: 'created', 'deleted', 'modified',
+        'moved' and 'overflow'.
+
+        On Linux the changes come from inotify: a rename inside the
+        tree is a single 'moved' event.  Elsewhere, or with poll=True,
+        the tree is compared with a snapshot of it every 'interval'
+        seconds (see TreeSnapshot), and renames show as 'deleted' and
+        'created' events.
+
+        Example:
+
+            with d.watch(pattern='*.log', events=['created']) as w:
+                for event in w:
+                    process(event.path)
+        """
+        return TreeWatcher(self, recursive, pattern, events, poll, interval)
+
     #
     # --- Special stuff from os
 
@@ -1111,6 +3609,18 @@ class path(unicode):
             os.startfile(self)
             return self
 
+    #
+    # --- Asynchronous access
+
+    if 'trollius' in globals() and 'ThreadPoolExecutor' in globals():
+        @property
+        def aio(self):
+            """ An AsyncPath for this path: its methods return futures
+            and run on a thread pool instead of blocking.  Only there
+            when trollius and futures are installed.
+            """
+            return AsyncPath(self)
+
 class tempdir(path):
     """
     A temporary directory via tempfile.mkdtemp, and constructed with the
@@ -1142,3 +3652,1679 @@ class tempdir(path):
     def __exit__(self, exc_type, exc_value, traceback):
         if not exc_value:
             self.rmtree()
+
+def _stat_or_lstat(filename):
+    """ stat() a file, or lstat() it if it is a dangling symlink. """
+    try:
+        return os.stat(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return os.lstat(filename)
+
+def _stat_key(st):
+    """ Return the (device, inode, size, mtime_ns) identity of a stat(). """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+class DigestCache(object):
+    """
+    A persistent cache of file digests stored in an SQLite database.
+
+    A digest is remembered per (device, inode, hash name) together with
+    the size and the modification time the file had when it was hashed,
+    and it is only returned while the file still has that size and
+    mtime, so a cache hit costs one stat() instead of reading the file.
+
+    max_entries - When given, the least recently used digests are
+        evicted once the cache holds more entries than this.
+
+    Example:
+
+        with DigestCache('~/.digests.db') as cache:
+            for f in d.walkfiles():
+                print f, f.read_hexhash('sha1', cache=cache)
+    """
+
+    _flush_every = 1000
+
+    def __init__(self, filename, max_entries=None):
+        self.filename = path(filename).expand()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.text_factory = unicode
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            ' dev INTEGER, ino INTEGER, hash_name TEXT, size INTEGER,'
+            ' mtime_ns INTEGER, path TEXT, digest BLOB, used REAL,'
+            ' PRIMARY KEY (dev, ino, hash_name))')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS digests_path ON digests (path)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS digests_used ON digests (used)')
+        self._count = self._db.execute(
+            'SELECT COUNT(*) FROM digests').fetchone()[0]
+        self._changes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def hit_rate(self):
+        """ The fraction of lookups answered from the cache. """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def lookup(self, filename, hash_name, st=None):
+        """ Return the cached digest of a file, or None.
+
+        'st' is the stat() of the file, if the caller already has it.
+        """
+        if st is None:
+            st = os.stat(filename)
+        dev, ino, size, mtime_ns = _stat_key(st)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime_ns, digest FROM digests'
+                ' WHERE dev = ? AND ino = ? AND hash_name = ?',
+                (dev, ino, hash_name)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                'UPDATE digests SET used = ?'
+                ' WHERE dev = ? AND ino = ? AND hash_name = ?',
+                (time.time(), dev, ino, hash_name))
+            self._changed()
+            return str(row[2])
+
+    def store(self, filename, hash_name, digest, st):
+        """ Remember the digest of a file.
+
+        'st' must be the stat() of the file taken before it was read, so
+        a file modified while it was being hashed is not trusted later.
+        """
+        dev, ino, size, mtime_ns = _stat_key(st)
+        with self._lock:
+            exists = self._db.execute(
+                'SELECT 1 FROM digests'
+                ' WHERE dev = ? AND ino = ? AND hash_name = ?',
+                (dev, ino, hash_name)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO digests'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (dev, ino, hash_name, size, mtime_ns,
+                 path(filename).abspath(), sqlite3.Binary(digest),
+                 time.time()))
+            if not exists:
+                self._count += 1
+            if self.max_entries is not None and \
+                    self._count > self.max_entries:
+                # Evict a tenth of the cache at once, so a full cache
+                # does not pay for an eviction on every insert.
+                keep = self.max_entries - self.max_entries // 10
+                self._db.execute(
+                    'DELETE FROM digests WHERE rowid IN ('
+                    ' SELECT rowid FROM digests ORDER BY used LIMIT ?)',
+                    (self._count - keep,))
+                self._count = keep
+            self._changed()
+
+    def digest(self, filename, hash_name):
+        """ Return the digest of a file, hashing it only on a cache miss. """
+        st = os.stat(filename)
+        digest = self.lookup(filename, hash_name, st)
+        if digest is None:
+            digest = path(filename)._hash(hash_name).digest()
+            self.store(filename, hash_name, digest, st)
+        return digest
+
+    def invalidate(self, paths=None, prefix=None):
+        """ Forget the digests of the given files, or of every file under
+        the directory 'prefix'.  Without arguments everything is dropped.
+        """
+        with self._lock:
+            if paths is None and prefix is None:
+                self._db.execute('DELETE FROM digests')
+            if paths is not None:
+                self._db.executemany(
+                    'DELETE FROM digests WHERE path = ?',
+                    ((path(p).abspath(),) for p in paths))
+            if prefix is not None:
+                prefix = path(prefix).abspath()
+                self._db.execute(
+                    'DELETE FROM digests WHERE path = ?'
+                    ' OR substr(path, 1, ?) = ?',
+                    (prefix, len(prefix) + 1, prefix / u''))
+            self._count = self._db.execute(
+                'SELECT COUNT(*) FROM digests').fetchone()[0]
+            self._db.commit()
+            self._changes = 0
+
+    def flush(self):
+        """ Commit pending changes to disk. """
+        with self._lock:
+            self._db.commit()
+            self._changes = 0
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self._flush_every:
+            self._db.commit()
+            self._changes = 0
+
+class FileIndex(object):
+    """
+    A persistent, queryable index of the files in a directory tree,
+    stored in an SQLite database with indexes on the extension, size,
+    modification time and directory of the files.
+
+    refresh() brings the index up to date.  It only lists again the
+    directories whose modification time changed, which is the case
+    whenever an entry is created, removed or renamed in them, so an
+    unchanged tree costs one stat() per directory.  A file rewritten
+    in place does not change its directory, so its new size and time
+    are only picked up by refresh(stat_files=True).
+
+    Example:
+
+        with FileIndex('~/.scans.db', '/data/scans') as index:
+            index.refresh()
+            week = time.time() - 7 * 24 * 3600
+            for f in index.query(ext='.dcm', min_size=10 << 20,
+                                 modified_after=week):
+                print f
+    """
+
+    def __init__(self, filename, root=None):
+        self.filename = path(filename).expand()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.text_factory = unicode
+        self._db.create_function('fnmatch', 2, fnmatch.fnmatchcase)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);'
+            'CREATE TABLE IF NOT EXISTS dirs ('
+            ' id INTEGER PRIMARY KEY, parent INTEGER, rel TEXT UNIQUE,'
+            ' mtime_ns INTEGER);'
+            'CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);'
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' dir INTEGER, name TEXT, ext TEXT, size INTEGER, mtime REAL,'
+            ' PRIMARY KEY (dir, name));'
+            'CREATE INDEX IF NOT EXISTS files_ext ON files (ext);'
+            'CREATE INDEX IF NOT EXISTS files_size ON files (size);'
+            'CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);')
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'root'").fetchone()
+        if row is not None:
+            if root is not None and path(root).abspath() != row[0]:
+                raise ValueError("'%s' is an index of '%s'" % (
+                    self.filename, row[0]))
+            root = row[0]
+        elif root is None:
+            raise ValueError("a new index needs a root directory")
+        else:
+            root = path(root).abspath()
+            self._db.execute(
+                "INSERT INTO meta VALUES ('root', ?)", (unicode(root),))
+            self._db.commit()
+        self.root = path(root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def refresh(self, stat_files=False, errors='warn'):
+        """ Update the index from the tree.
+
+        Directories whose modification time did not change are not
+        listed again.  With stat_files=True the files in them are still
+        stat()ed, to catch files rewritten in place.  Symbolic links to
+        directories are not followed.  The errors= keyword argument
+        works as for path.walk().
+
+        Returns the number of directories that were listed.
+        """
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
+        join = os.path.join
+        with self._lock:
+            db = self._db
+            known = {}
+            children = collections.defaultdict(list)
+            for dir_id, parent, rel, mtime_ns in db.execute(
+                    'SELECT id, parent, rel, mtime_ns FROM dirs'):
+                known[rel] = (dir_id, mtime_ns)
+                children[parent].append(rel)
+            ids = dict((rel, value[0]) for rel, value in known.iteritems())
+            seen = set()
+            listed = 0
+
+            stack = [u'']
+            while stack:
+                rel = stack.pop()
+                directory = join(self.root, rel) if rel else self.root
+                try:
+                    mtime_ns = _stat_key(os.stat(directory))[3]
+                except OSError:
+                    _walk_error(errors, "Unable to access '%s': %s", directory)
+                    continue
+                seen.add(rel)
+                old = known.get(rel)
+                if old is not None and old[1] == mtime_ns:
+                    if stat_files:
+                        self._stat_files(old[0], directory, errors)
+                    stack.extend(children[old[0]])
+                    continue
+
+                try:
+                    entries = _scandir(directory)
+                except OSError:
+                    _walk_error(
+                        errors, "Unable to list directory '%s': %s", directory)
+                    continue
+                listed += 1
+                if old is None:
+                    parent = ids.get(os.path.dirname(rel)) if rel else None
+                    dir_id = ids[rel] = db.execute(
+                        'INSERT INTO dirs (parent, rel, mtime_ns)'
+                        ' VALUES (?, ?, ?)', (parent, rel, mtime_ns)).lastrowid
+                else:
+                    dir_id = old[0]
+                    db.execute('UPDATE dirs SET mtime_ns = ? WHERE id = ?',
+                               (mtime_ns, dir_id))
+
+                rows = []
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(join(rel, entry.name))
+                            continue
+                        if not entry.is_file():
+                            continue
+                        st = entry.stat()
+                    except OSError:
+                        _walk_error(
+                            errors, "Unable to access '%s': %s", entry.path)
+                        continue
+                    rows.append((dir_id, entry.name,
+                                 os.path.splitext(entry.name)[1].lower(),
+                                 st.st_size, st.st_mtime))
+                db.execute('DELETE FROM files WHERE dir = ?', (dir_id,))
+                db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', rows)
+
+            # Whatever was not reached is gone from the tree.
+            for rel, (dir_id, mtime_ns) in known.iteritems():
+                if rel not in seen:
+                    db.execute('DELETE FROM files WHERE dir = ?', (dir_id,))
+                    db.execute('DELETE FROM dirs WHERE id = ?', (dir_id,))
+            db.commit()
+            return listed
+
+    def _stat_files(self, dir_id, directory, errors):
+        """ Update the size and time of the files of a directory. """
+        join = os.path.join
+        updates = []
+        for name, size, mtime in self._db.execute(
+                'SELECT name, size, mtime FROM files WHERE dir = ?',
+                (dir_id,)).fetchall():
+            try:
+                st = os.stat(join(directory, name))
+            except OSError:
+                _walk_error(errors, "Unable to access '%s': %s",
+                            join(directory, name))
+                continue
+            if st.st_size != size or st.st_mtime != mtime:
+                updates.append((st.st_size, st.st_mtime, dir_id, name))
+        self._db.executemany(
+            'UPDATE files SET size = ?, mtime = ? WHERE dir = ? AND name = ?',
+            updates)
+
+    def query(self, ext=None, pattern=None, min_size=None, max_size=None,
+              modified_after=None, modified_before=None, under=None,
+              order_by=None, limit=None):
+        """ Return the list of indexed files matching all the given
+        conditions, as path objects.
+
+        ext - An extension, such as '.dcm', or a list of them.  Case
+            is ignored.
+        pattern - A glob pattern the file name must match, such as
+            'IMG_*', with the syntax of fnmatch.fnmatchcase().  It is
+            case sensitive.
+        min_size, max_size - Bounds of the size in bytes, inclusive.
+        modified_after, modified_before - Bounds of the modification
+            time, as a timestamp or a datetime, inclusive.
+        under - Only files below this directory, given relative to
+            the root or as an absolute path inside it.
+        order_by - 'size', 'mtime', 'name' or 'path'; prefix it with
+            '-' for descending order.
+        limit - The most files to return.
+        """
+        where, params = [], []
+        if ext is not None:
+            exts = [ext] if isinstance(ext, basestring) else list(ext)
+            where.append('files.ext IN (%s)' % ', '.join('?' * len(exts)))
+            params.extend(e.lower() for e in exts)
+        if pattern is not None:
+            where.append('fnmatch(files.name, ?)')
+            params.append(pattern)
+        for column, op, value in (('size', '>=', min_size),
+                                  ('size', '<=', max_size),
+                                  ('mtime', '>=', modified_after),
+                                  ('mtime', '<=', modified_before)):
+            if value is not None:
+                if hasattr(value, 'timetuple'):
+                    value = time.mktime(value.timetuple())
+                where.append('files.%s %s ?' % (column, op))
+                params.append(value)
+        if under is not None:
+            rel = path(under)
+            if rel.isabs():
+                rel = self.root.relpathto(rel)
+            rel = os.path.normpath(rel)
+            if rel != os.curdir:
+                where.append('(dirs.rel = ? OR substr(dirs.rel, 1, ?) = ?)')
+                params.extend((rel, len(rel) + 1, os.path.join(rel, u'')))
+
+        sql = 'SELECT dirs.rel, files.name FROM files' \
+              ' JOIN dirs ON files.dir = dirs.id'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if order_by is not None:
+            column = order_by.lstrip('-')
+            columns = {'size': 'files.size', 'mtime': 'files.mtime',
+                       'name': 'files.name',
+                       'path': 'dirs.rel, files.name'}
+            if column not in columns:
+                raise ValueError("invalid order_by: %r" % order_by)
+            direction = ' DESC' if order_by.startswith('-') else ''
+            sql += ' ORDER BY ' + ', '.join(
+                c + direction for c in columns[column].split(', '))
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+
+        join = os.path.join
+        root = self.root
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [path(join(root, dir_rel, name)) for dir_rel, name in rows]
+
+    def close(self):
+        self._db.close()
+
+def _hash_file(args):
+    """
+    Work item of hash_many().  Returns (filename, digest, error, st)
+    where only one of digest and error is set, and st is the stat() of
+    the file taken before it was read, or None when the digest came
+    from the cache.
+    """
+    filename, hash_name, digest = args
+    if digest is not None:
+        return filename, digest, None, None
+    try:
+        st = os.stat(filename)
+        if isinstance(hash_name, basestring):
+            return filename, path(filename)._hash(hash_name).digest(), None, st
+        digests = dict((name, m.digest()) for name, m in
+                       zip(hash_name, path(filename)._hashes(hash_name)))
+        return filename, digests, None, st
+    except Exception, e:
+        return filename, None, e, None
+
+_BINARY_SNIFF = 8192
+
+# Line ends are counted in slices of this size, so the text between
+# two matches is never copied out of the map at once.
+_GREP_COUNT_CHUNK = 1 << 20
+
+_grep_regexes = {}
+_grep_queue = []
+
+def _count_newlines(data, start, stop):
+    """ Count the line ends in data[start:stop], a slice at a time. """
+    count = 0
+    while start < stop:
+        end = min(start + _GREP_COUNT_CHUNK, stop)
+        count += data[start:end].count('\n')
+        start = end
+    return count
+
+def _grep_lines(filename, source, flags, binary):
+    """
+    Search a file for a byte regular expression and yield (line_no,
+    line) for every line with a match, as it is found.  Binary files,
+    those with a NUL byte in their first 8 KiB, give no lines unless
+    'binary' is true.
+    """
+    regex = _grep_regexes.get((source, flags))
+    if regex is None:
+        regex = _grep_regexes[source, flags] = re.compile(source, flags)
+    with path(filename).mmap() as data:
+        if not binary and '\0' in data[:_BINARY_SNIFF]:
+            return
+        line_no, counted = 1, 0
+        pos, end = 0, len(data)
+        # A match at the very end, after the last line end, is not
+        # on any line.
+        last = end - 1 if data[end - 1:end] == '\n' else end
+        while pos < end:
+            m = regex.search(data, pos)
+            if m is None or m.start() > last:
+                break
+            start = data.rfind('\n', 0, m.start()) + 1
+            stop = data.find('\n', m.end())
+            if stop < 0:
+                stop = end
+            line_no += _count_newlines(data, counted, start)
+            counted = start
+            line = data[start:stop]
+            if line.endswith('\r'):
+                line = line[:-1]
+            yield line_no, line
+            pos = stop + 1
+
+def _grep_init(queue):
+    """ Set up a process of the path.grep() pool. """
+    _grep_queue[:] = [queue]
+
+def _grep_file(args):
+    """
+    Work item of path.grep().  Put (filename, line_no, line, None) on
+    the queue of the pool for every line found, then (filename, None,
+    None, error) when the file is done, the error being an exception
+    or None.
+    """
+    queue, filename = _grep_queue[0], args[0]
+    try:
+        for line_no, line in _grep_lines(*args):
+            queue.put((filename, line_no, line, None))
+    except Exception, e:
+        queue.put((filename, None, None, e))
+    else:
+        queue.put((filename, None, None, None))
+
+def hash_many(paths, hash_name='md5', workers=None, errors='strict',
+              hexdigest=False, cache=None):
+    """ Calculate the given hash for many files at once.
+
+    The files are spread over a pool of 'workers' processes (by default
+    one per CPU) and the generator yields (path, digest) tuples in the
+    order the files are finished, not the order of 'paths'.  With
+    workers=1 everything is done in the calling process.  Pass
+    hexdigest=True to get hex digests instead of raw ones, and a
+    DigestCache as 'cache' to skip files whose digest is known.
+
+    'hash_name' may also be a list of hash names, and then each file is
+    read once for all of them and its digest is a dict of hash name ->
+    digest, as returned by path.read_hashes().
+
+    The errors= keyword argument controls what happens when a file
+    can not be hashed.  The default is 'strict', which stops at the
+    first failure and raises its exception.  With 'warn' or 'ignore'
+    the file is yielded with None as its digest, and 'warn' also
+    reports the error via warnings.warn().
+    """
+    if errors not in ('strict', 'warn', 'ignore'):
+        raise ValueError("invalid errors parameter")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+
+    multiple = not isinstance(hash_name, basestring)
+    if multiple:
+        hash_name = list(hash_name)
+
+    def lookup(p):
+        if not multiple:
+            return cache.lookup(p, hash_name)
+        st = os.stat(p)
+        digests = {}
+        for name in hash_name:
+            digests[name] = cache.lookup(p, name, st)
+            if digests[name] is None:
+                return None
+        return digests
+
+    def tasks():
+        for p in paths:
+            digest = None
+            if cache is not None:
+                try:
+                    digest = lookup(p)
+                except OSError:
+                    pass
+            yield p, hash_name, digest
+
+    if workers == 1:
+        pool = None
+        results = (_hash_file(task) for task in tasks())
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_hash_file, tasks(), 16)
+
+    try:
+        for filename, digest, error, st in results:
+            if error is not None:
+                if errors == 'strict':
+                    raise error
+                elif errors == 'warn':
+                    warnings.warn(
+                        "Unable to hash '%s': %s" % (filename, error),
+                        HashWarning)
+            else:
+                if multiple:
+                    if cache is not None and st is not None:
+                        for name, value in digest.iteritems():
+                            cache.store(filename, name, value, st)
+                    if hexdigest:
+                        digest = dict((name, value.encode('hex'))
+                                      for name, value in digest.iteritems())
+                else:
+                    if cache is not None and st is not None:
+                        cache.store(filename, hash_name, digest, st)
+                    if hexdigest:
+                        digest = digest.encode('hex')
+            yield filename, digest
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if cache is not None:
+            cache.flush()
+
+_ENDS_SIZE = 1 << 16
+
+def _hash_ends(args):
+    """
+    Work item of find_duplicates().  Hash the first and last 64 KiB of
+    a file, or all of it if it is not longer than that.  Returns
+    (filename, digest, error) where only one of digest and error is
+    set.
+    """
+    filename, hash_name = args
+    try:
+        fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            m = hashlib.new(hash_name)
+            m.update(os.read(fd, _ENDS_SIZE))
+            size = os.fstat(fd).st_size
+            if size > _ENDS_SIZE:
+                os.lseek(fd, max(size - _ENDS_SIZE, _ENDS_SIZE), os.SEEK_SET)
+                m.update(os.read(fd, _ENDS_SIZE))
+        finally:
+            os.close(fd)
+        return filename, m.digest(), None
+    except Exception, e:
+        return filename, None, e
+
+def _link_over(source, target):
+    """ Replace 'target' with a hard link to 'source', atomically. """
+    directory, name = os.path.split(target)
+    temp = os.path.join(directory, '.%s.%s.tmp' % (
+        name, binascii.hexlify(os.urandom(4))))
+    os.link(source, temp)
+    try:
+        _replace(temp, target)
+    except:
+        os.unlink(temp)
+        raise
+    _stat_changed(target)
+
+def find_duplicates(roots, workers=None, hash_name='sha1', min_size=1,
+                    errors='strict', cache=None, link=False):
+    """ Find the files with the same content under one or more
+    directories.
+
+    'roots' is a directory or a list of them.  The files are compared
+    in stages, each only for the files that still look alike: first by
+    size, then by a hash of their first and last 64 KiB and last by a
+    hash of all their content, done with hash_many() and the given
+    DigestCache, if any.  The hashing is spread over a pool of
+    'workers' processes, as in hash_many().  Files smaller than
+    'min_size' bytes and symbolic links are skipped, and hard links to
+    a file already found are not reported, they take no space.
+
+    The generator yields each group of duplicates as a sorted list of
+    paths.  With link=True every file in a group but the first is
+    replaced by a hard link to the first before the group is yielded;
+    files on another device than the first are left alone.
+
+    'errors' is handled as for walk() and hash_many(); files that can
+    not be read are left out.
+    """
+    if errors not in ('strict', 'warn', 'ignore'):
+        raise ValueError("invalid errors parameter")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    if isinstance(roots, basestring):
+        roots = [roots]
+
+    # Stage 1: group by size, one path per inode.
+    by_size = collections.defaultdict(list)
+    devices = {}
+    inodes = set()
+    for root in roots:
+        for child, entry, isdir in path(root)._walk_entries(errors):
+            try:
+                if isdir or not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                _walk_error(errors, "Unable to access '%s': %s", child)
+                continue
+            key = (st.st_dev, st.st_ino)
+            if st.st_size < min_size or key in inodes:
+                continue
+            inodes.add(key)
+            devices[child] = st.st_dev
+            by_size[st.st_size].append(child)
+    del inodes
+
+    def regroup(results, group_of):
+        """ Split groups by the digests in 'results'. """
+        groups = collections.defaultdict(list)
+        for filename, digest in results:
+            if digest is not None:
+                groups[group_of[filename], digest].append(filename)
+        return [g for g in groups.itervalues() if len(g) > 1]
+
+    def report(group):
+        group.sort()
+        if link:
+            first = group[0]
+            for other in group[1:]:
+                if devices[other] != devices[first]:
+                    continue
+                try:
+                    _link_over(first, other)
+                except OSError:
+                    _walk_error(errors, "Unable to link '%s': %s", other)
+        return group
+
+    # Stage 2: hash the ends of the files of the same size.
+    group_of = dict((p, size) for size, group in by_size.iteritems()
+                    if len(group) > 1 for p in group)
+    by_size.clear()
+    tasks = ((p, hash_name) for p in group_of)
+    if workers == 1 or len(group_of) < 2:
+        pool = None
+        results = itertools.imap(_hash_ends, tasks)
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_hash_ends, tasks, 16)
+
+    def checked(results):
+        for filename, digest, error in results:
+            if error is not None:
+                if errors == 'strict':
+                    raise error
+                elif errors == 'warn':
+                    warnings.warn(
+                        "Unable to hash '%s': %s" % (filename, error),
+                        HashWarning)
+            yield filename, digest
+
+    try:
+        groups = regroup(checked(results), group_of)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    # Files no longer than both ends were hashed whole already.
+    candidates = {}
+    for number, group in enumerate(groups):
+        if group_of[group[0]] <= 2 * _ENDS_SIZE:
+            yield report(group)
+        else:
+            for p in group:
+                candidates[p] = number
+    del groups, group_of
+
+    # Stage 3: hash all of the files still alike.
+    if candidates:
+        results = hash_many(list(candidates), hash_name,
+                            min(workers, len(candidates)), errors,
+                            cache=cache)
+        for group in regroup(results, candidates):
+            yield report(group)
+
+TreeDiff = collections.namedtuple('TreeDiff', 'added removed modified')
+
+class TreeSnapshot(object):
+    """
+    The state of a directory tree at one point in time: for every
+    directory its modification time and entries, and for every entry
+    whether it is a directory, its size and its modification time.
+    Paths are relative to the root, with os.sep as the separator.
+
+    Snapshots are taken with TreeSnapshot.scan(), written to a compact
+    binary file with save() and read back with TreeSnapshot.load().
+    older.diff(newer) tells what changed in between.
+
+    Example:
+
+        before = TreeSnapshot.load('tree.snap')
+        after = before.rescan()
+        print after.diff(before)
+        after.save('tree.snap')
+    """
+
+    _magic = 'TSNP\x01'
+
+    def __init__(self, root, dirs):
+        self.root = path(root)
+        # relative dir -> (mtime_ns, [(name, isdir, size, mtime_ns)])
+        self.dirs = dirs
+
+    @classmethod
+    def scan(cls, root, previous=None, stat_files=True, errors='strict'):
+        """ Take a snapshot of the tree under 'root'.
+
+        When a 'previous' snapshot of the same root is given, every
+        directory whose modification time has not changed since then
+        is not listed again; its entries are taken from 'previous'.
+        A directory's time changes whenever an entry is created,
+        removed or renamed in it, so this is safe for the tree's shape.
+        It does not change when a file is rewritten in place, so the
+        files of such directories are still stat()ed, unless
+        stat_files=False.  Then a rescan of an unchanged tree costs a
+        single stat() per directory, but in-place modifications of
+        files in unchanged directories go unnoticed.
+
+        The errors= keyword argument works as for path.walk().
+        """
+        if errors not in ('strict', 'warn', 'ignore'):
+            raise ValueError("invalid errors parameter")
+        root = path(root)
+        previous_dirs = {}
+        if previous is not None and previous.root == root:
+            previous_dirs = previous.dirs
+        join = os.path.join
+
+        dirs = {}
+        try:
+            mtime = _stat_key(os.stat(root))[3]
+        except OSError:
+            _walk_error(errors, "Unable to access '%s': %s", root)
+            return cls(root, dirs)
+
+        stack = [(u'', root, mtime)]
+        while stack:
+            rel, directory, mtime = stack.pop()
+            children = []
+            old = previous_dirs.get(rel)
+            if old is not None and old[0] == mtime:
+                for child in old[1]:
+                    name, isdir = child[:2]
+                    if isdir or stat_files:
+                        filename = join(directory, name)
+                        try:
+                            st = _stat_or_lstat(filename)
+                        except OSError:
+                            _walk_error(
+                                errors, "Unable to access '%s': %s", filename)
+                            continue
+                        child = (name, stat.S_ISDIR(st.st_mode),
+                                 st.st_size, _stat_key(st)[3])
+                    children.append(child)
+            else:
+                try:
+                    entries = _scandir(directory)
+                except OSError:
+                    _walk_error(
+                        errors, "Unable to list directory '%s': %s", directory)
+                    entries = []
+                for entry in entries:
+                    try:
+                        try:
+                            st = entry.stat()
+                        except OSError, e:
+                            if e.errno != errno.ENOENT:
+                                raise
+                            # A dangling symlink.
+                            st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        _walk_error(
+                            errors, "Unable to access '%s': %s", entry.path)
+                        continue
+                    children.append((entry.name, stat.S_ISDIR(st.st_mode),
+                                     st.st_size, _stat_key(st)[3]))
+
+            dirs[rel] = (mtime, children)
+            for name, isdir, size, child_mtime in children:
+                if isdir:
+                    stack.append((join(rel, name), join(directory, name),
+                                  child_mtime))
+        return cls(root, dirs)
+
+    def rescan(self, stat_files=True, errors='strict'):
+        """ Take a new snapshot of the same tree, using this one to skip
+        the directories that did not change.  See TreeSnapshot.scan().
+        """
+        return self.scan(self.root, self, stat_files, errors)
+
+    def entries(self):
+        """ Return a dict of relative path -> (isdir, size, mtime_ns). """
+        join = os.path.join
+        result = {}
+        for rel, (mtime, children) in self.dirs.iteritems():
+            for name, isdir, size, child_mtime in children:
+                result[join(rel, name)] = (isdir, size, child_mtime)
+        return result
+
+    def __len__(self):
+        return sum(len(children) for mtime, children in self.dirs.itervalues())
+
+    def __iter__(self):
+        """ Iterate over the relative paths of all entries. """
+        join = os.path.join
+        for rel, (mtime, children) in self.dirs.iteritems():
+            for child in children:
+                yield join(rel, child[0])
+
+    def diff(self, newer):
+        """ Compare this snapshot with a newer one of the same tree.
+
+        Returns a TreeDiff of sorted lists of relative paths: 'added'
+        and 'removed' entries, and 'modified' files, whose size or
+        modification time changed.  An entry that changed between file
+        and directory counts as removed and added.
+        """
+        added, removed, modified = [], [], []
+        join = os.path.join
+        old_dirs = self.dirs
+        for rel, (mtime, children) in newer.dirs.iteritems():
+            old = old_dirs.get(rel)
+            if old is None:
+                added.extend(join(rel, child[0]) for child in children)
+                continue
+            old_children = dict((c[0], c) for c in old[1])
+            for child in children:
+                name = child[0]
+                old_child = old_children.pop(name, None)
+                if old_child is None or old_child[1] != child[1]:
+                    added.append(join(rel, name))
+                    if old_child is not None:
+                        removed.append(join(rel, name))
+                elif not child[1] and old_child[2:] != child[2:]:
+                    modified.append(join(rel, name))
+            removed.extend(join(rel, name) for name in old_children)
+        for rel, (mtime, children) in old_dirs.iteritems():
+            if rel not in newer.dirs:
+                removed.extend(join(rel, child[0]) for child in children)
+        added.sort()
+        removed.sort()
+        modified.sort()
+        return TreeDiff(added, removed, modified)
+
+    def save(self, filename):
+        """ Write this snapshot to a file. """
+        data = marshal.dumps((unicode(self.root), self.dirs.items()))
+        with open(filename, 'wb') as f:
+            f.write(self._magic)
+            f.write(zlib.compress(data))
+
+    @classmethod
+    def load(cls, filename):
+        """ Read a snapshot written by TreeSnapshot.save(). """
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if not data.startswith(cls._magic):
+            raise ValueError("'%s' is not a tree snapshot" % filename)
+        root, dirs = marshal.loads(zlib.decompress(data[len(cls._magic):]))
+        return cls(root, dict(dirs))
+
+class PathTable(object):
+    """
+    A compact list of paths, for collections too big to keep as path
+    objects.
+
+    Every directory is stored once, as the id of its parent directory
+    and its own name, and every path as the id of its directory and
+    its name, with equal names shared.  So the shared prefixes of the
+    paths cost nothing per path; a path costs a few machine words plus
+    its name, if the name is not used elsewhere.  The path objects are
+    only built when an item is accessed.
+
+    The attributes 'name', 'ext' and 'parent' give the corresponding
+    path attribute for every item at once, and relpaths() relative
+    paths, each computed once per distinct name or directory rather
+    than once per item.
+
+    Example:
+
+        table = PathTable.from_walk(root, kind='files')
+        big = [p for p, size in zip(table, sizes) if size > limit]
+    """
+
+    def __init__(self, paths=(), path_class=path):
+        self.path_class = path_class
+        # directories: id -> parent id (-1 for roots) and name, and
+        # (parent id, name) -> id to intern them.
+        self._dir_parent = array.array('l')
+        self._dir_name = []
+        self._dir_ids = {}
+        # full directory strings already built, by id
+        self._dir_strings = {}
+        # paths: index -> directory id and name
+        self._parent = array.array('l')
+        self._name = []
+        self._names = {}
+        self._last_dir = (None, -1)
+        self.extend(paths)
+
+    @classmethod
+    def from_walk(cls, root, pattern=None, errors='strict', kind=None):
+        """ Build a table from root.walk(), or root.walkfiles() with
+        kind='files' and root.walkdirs() with kind='dirs'.
+        """
+        root = path(root)
+        table = cls(path_class=root._next_class)
+        table.extend(_walk_select(root._walk_entries(errors), pattern,
+                                  errors, kind))
+        return table
+
+    def _intern_dir(self, directory):
+        """ Return the id of a directory string, adding it if needed. """
+        ids = self._dir_ids
+        head, tail = os.path.split(directory)
+        if not tail:
+            # A root ('/'), or a directory given with a trailing slash.
+            if not head or head == directory:
+                key = (-1, directory)
+            else:
+                return self._intern_dir(head)
+        else:
+            key = (self._intern_dir(head) if head else -1, tail)
+        try:
+            return ids[key]
+        except KeyError:
+            dir_id = ids[key] = len(self._dir_name)
+            self._dir_parent.append(key[0])
+            self._dir_name.append(key[1])
+            return dir_id
+
+    def append(self, p):
+        """ Add a path at the end of the table. """
+        head, tail = os.path.split(p)
+        last_head, dir_id = self._last_dir
+        if head != last_head:
+            dir_id = self._intern_dir(head) if head else -1
+            self._last_dir = (head, dir_id)
+        self._parent.append(dir_id)
+        self._name.append(self._names.setdefault(tail, tail))
+
+    def extend(self, paths):
+        """ Add many paths at the end of the table. """
+        for p in paths:
+            self.append(p)
+
+    def _dir_string(self, dir_id):
+        """ Return the full string of a directory. """
+        if dir_id < 0:
+            return u''
+        try:
+            return self._dir_strings[dir_id]
+        except KeyError:
+            parent = self._dir_parent[dir_id]
+            name = self._dir_name[dir_id]
+            result = os.path.join(self._dir_string(parent), name) \
+                if parent >= 0 else name
+            self._dir_strings[dir_id] = result
+            return result
+
+    def __len__(self):
+        return len(self._name)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return self.path_class(os.path.join(
+            self._dir_string(self._parent[index]), self._name[index]))
+
+    def __iter__(self):
+        cls = self.path_class
+        join = os.path.join
+        dir_string = self._dir_string
+        for dir_id, name in zip(self._parent, self._name):
+            yield cls(join(dir_string(dir_id), name))
+
+    @property
+    def name(self):
+        """ The name of every path, as a list. """
+        return list(self._name)
+
+    @property
+    def ext(self):
+        """ The extension of every path, as a list. """
+        splitext = os.path.splitext
+        exts = {}
+        result = []
+        for name in self._name:
+            try:
+                result.append(exts[name])
+            except KeyError:
+                exts[name] = splitext(name)[1]
+                result.append(exts[name])
+        return result
+
+    @property
+    def parent(self):
+        """ The parent directory of every path, as a list of path
+        objects shared by the paths of the same directory.
+        """
+        cls = self.path_class
+        parents = {}
+        result = []
+        for dir_id in self._parent:
+            try:
+                result.append(parents[dir_id])
+            except KeyError:
+                parents[dir_id] = cls(self._dir_string(dir_id))
+                result.append(parents[dir_id])
+        return result
+
+    def relpaths(self, start):
+        """ Return the list of start.relpathto(p) for every path p.
+
+        The relative path is worked out once per directory and only
+        joined with each name.
+        """
+        start = self.path_class(start)
+        join = os.path.join
+        relative = {}
+        result = []
+        for dir_id, name in zip(self._parent, self._name):
+            try:
+                rel = relative[dir_id]
+            except KeyError:
+                rel = relative[dir_id] = start.relpathto(
+                    self._dir_string(dir_id) or os.curdir)
+            result.append(self.path_class(
+                name if rel == os.curdir else join(rel, name)))
+        return result
+
+WatchEvent = collections.namedtuple('WatchEvent', 'kind path dest')
+
+_WATCH_KINDS = frozenset(['created', 'deleted', 'modified', 'moved',
+                          'overflow'])
+
+_IN_MODIFY, _IN_ATTRIB = 0x2, 0x4
+_IN_MOVED_FROM, _IN_MOVED_TO = 0x40, 0x80
+_IN_CREATE, _IN_DELETE, _IN_DELETE_SELF = 0x100, 0x200, 0x400
+_IN_Q_OVERFLOW, _IN_IGNORED = 0x4000, 0x8000
+_IN_ONLYDIR, _IN_DONT_FOLLOW = 0x1000000, 0x2000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK, _IN_CLOEXEC = 0x800, 0x80000
+_IN_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO |
+                  _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_ONLYDIR |
+                  _IN_DONT_FOLLOW)
+_IN_EVENT = struct.Struct('iIII')
+
+_inotify_init1 = _LibcFunction('inotify_init1', ctypes.c_int, [ctypes.c_int])
+_inotify_add_watch = _LibcFunction(
+    'inotify_add_watch', ctypes.c_int,
+    [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32])
+_inotify_rm_watch = _LibcFunction(
+    'inotify_rm_watch', ctypes.c_int, [ctypes.c_int, ctypes.c_int])
+
+def _have_inotify():
+    return sys.platform.startswith('linux') and bool(
+        _inotify_init1 and _inotify_add_watch and _inotify_rm_watch)
+
+class _InotifySource(object):
+    """
+    Events of a directory tree from Linux inotify, as (kind, path,
+    dest) tuples.  Every directory has its own watch; the watches
+    follow directories moved inside the tree and are added for new
+    ones as their creation is seen.
+    """
+
+    # How long to wait for the second half of a rename.
+    move_wait = 0.05
+
+    def __init__(self, root, recursive):
+        self.root = root
+        self.recursive = recursive
+        # close() may come from another thread while read() waits in
+        # select(): it then writes to this pipe to wake the reader up,
+        # and the descriptors are closed when the reader is done with
+        # them, so their numbers can not be reused under it.
+        self.closed = False
+        self.reading = False
+        self.lock = threading.Lock()
+        self.wake = os.pipe()
+        for fd in self.wake:
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.fd = _inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            e = _ctypes_error()
+            self._release()
+            raise e
+        self.paths = {}
+        self.wds = {}
+        try:
+            self.add(root)
+            if recursive:
+                for directory in root.walkdirs(errors='ignore'):
+                    self.add(directory)
+        except:
+            self.close()
+            raise
+
+    def add(self, directory):
+        """ Watch a directory.  Returns False if it is gone. """
+        wd = _inotify_add_watch(self.fd, _fs_encode(directory), _IN_WATCH_MASK)
+        if wd < 0:
+            e = _ctypes_error(directory)
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise e
+        self.paths[wd] = directory
+        self.wds[directory] = wd
+        return True
+
+    def add_tree(self, directory, events):
+        """ Watch a new directory and all below it.  The entries in it
+        were made before the watch, so they are reported as created.
+        """
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            if not self.add(directory):
+                continue
+            try:
+                entries = _scandir(directory)
+            except OSError:
+                continue
+            for entry in entries:
+                child = directory / entry.name
+                events.append(('created', child, None))
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(child)
+                except OSError:
+                    pass
+
+    def _subtree(self, directory):
+        """ The watched directories at or below 'directory'. """
+        prefix = directory + os.sep
+        return [d for d in self.wds if d == directory or d.startswith(prefix)]
+
+    def moved(self, src, dest):
+        """ Update the watches of a directory moved inside the tree. """
+        for directory in self._subtree(src):
+            wd = self.wds.pop(directory)
+            directory = dest + directory[len(src):]
+            self.paths[wd] = directory
+            self.wds[directory] = wd
+
+    def removed(self, directory):
+        """ Drop the watches of a directory moved out of the tree. """
+        for directory in self._subtree(directory):
+            wd = self.wds.pop(directory)
+            del self.paths[wd]
+            _inotify_rm_watch(self.fd, wd)
+
+    def _raw(self, timeout):
+        """ Read the pending inotify events, waiting up to 'timeout'. """
+        ready = select.select([self.fd, self.wake[0]], [], [], timeout)[0]
+        if self.fd not in ready or self.closed:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        result = []
+        offset, size = 0, _IN_EVENT.size
+        while offset < len(data):
+            wd, mask, cookie, length = _IN_EVENT.unpack_from(data, offset)
+            offset += size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            result.append((wd, mask, cookie, _fs_decode(name)))
+        return result
+
+    def read(self, timeout=None):
+        with self.lock:
+            if self.closed:
+                return []
+            self.reading = True
+        try:
+            events = []
+            moves = {}
+            raw = self._raw(timeout)
+            while raw:
+                for wd, mask, cookie, name in raw:
+                    self._event(wd, mask, cookie, name, moves, events)
+                # A rename's halves may come in separate reads.
+                raw = self._raw(self.move_wait) if moves else None
+            for src, isdir in moves.itervalues():
+                # Moved out of the tree.
+                events.append(('deleted', src, None))
+                if isdir:
+                    self.removed(src)
+            return events
+        finally:
+            with self.lock:
+                self.reading = False
+                if self.closed:
+                    self._release()
+
+    def _event(self, wd, mask, cookie, name, moves, events):
+        if mask & _IN_Q_OVERFLOW:
+            events.append(('overflow', self.root, None))
+            return
+        if mask & _IN_IGNORED:
+            directory = self.paths.pop(wd, None)
+            if self.wds.get(directory) == wd:
+                del self.wds[directory]
+            return
+        directory = self.paths.get(wd)
+        if directory is None:
+            return
+        if not name:
+            if mask & _IN_DELETE_SELF and directory == self.root:
+                events.append(('deleted', directory, None))
+            return
+
+        filename = directory / name
+        isdir = mask & _IN_ISDIR
+        if mask & _IN_CREATE:
+            events.append(('created', filename, None))
+            if isdir and self.recursive:
+                self.add_tree(filename, events)
+        elif mask & _IN_DELETE:
+            events.append(('deleted', filename, None))
+        elif mask & _IN_MOVED_FROM:
+            moves[cookie] = (filename, isdir)
+        elif mask & _IN_MOVED_TO:
+            src = moves.pop(cookie, None)
+            if src is not None:
+                events.append(('moved', src[0], filename))
+                if isdir and src[0] in self.wds:
+                    self.moved(src[0], filename)
+                elif isdir and self.recursive:
+                    # Moved before its watch could be added.
+                    self.add_tree(filename, events)
+            else:
+                events.append(('created', filename, None))
+                if isdir and self.recursive:
+                    self.add_tree(filename, events)
+        elif mask & (_IN_MODIFY | _IN_ATTRIB) and not isdir:
+            events.append(('modified', filename, None))
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.reading:
+                os.write(self.wake[1], '\0')
+            else:
+                self._release()
+
+    def _release(self):
+        for fd in (self.fd,) + self.wake:
+            if fd >= 0:
+                os.close(fd)
+        self.fd = -1
+        self.wake = (-1, -1)
+
+class _PollSource(object):
+    """
+    Events of a directory tree found by comparing TreeSnapshots taken
+    every 'interval' seconds.  Renames show as deletes and creates.
+    """
+
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.snapshot = TreeSnapshot.scan(root, errors='ignore')
+        self.next_scan = time.time() + interval
+        self.closed = False
+
+    def read(self, timeout=None):
+        # Scan until something changed, the timeout expires or the
+        # watcher is closed.
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.closed:
+            now = time.time()
+            if timeout is not None and self.next_scan > deadline:
+                time.sleep(max(deadline - now, 0))
+                break
+            if self.next_scan > now:
+                time.sleep(self.next_scan - now)
+            snapshot = self.snapshot.rescan(errors='ignore')
+            self.next_scan = time.time() + self.interval
+            diff = self.snapshot.diff(snapshot)
+            self.snapshot = snapshot
+            if any(diff):
+                root = self.root
+                return (
+                    [('deleted', root / rel, None) for rel in diff.removed] +
+                    [('created', root / rel, None) for rel in diff.added] +
+                    [('modified', root / rel, None) for rel in diff.modified])
+        return []
+
+    def close(self):
+        self.closed = True
+
+class TreeWatcher(object):
+    """
+    Reports the changes made to a directory tree, as WatchEvent
+    tuples (kind, path, dest).  'kind' is one of 'created', 'deleted',
+    'modified', 'moved' (and then 'dest' is the new path; it is None
+    otherwise) or 'overflow'.  Made by path.watch(), see there.
+
+    Events are read with read(), or by iterating over the watcher,
+    which blocks until close() is called.  run() sends them to the
+    'changed' Signal instead, whose slots are called with the event.
+    """
+
+    def __init__(self, root, recursive=True, pattern=None, events=None,
+                 poll=None, interval=1.0):
+        root = path(root)
+        if events is not None:
+            events = frozenset(events)
+            if not events <= _WATCH_KINDS:
+                raise ValueError("invalid events: %s" % ', '.join(
+                    sorted(events - _WATCH_KINDS)))
+        if not root.isdir():
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), root)
+        self.root = root
+        self.recursive = recursive
+        self.events = events
+        self._match = _name_matcher(pattern) if pattern else None
+        if poll is None:
+            poll = not _have_inotify()
+        self.polling = poll
+        if poll:
+            self._source = _PollSource(root, interval)
+        else:
+            self._source = _InotifySource(root, recursive)
+        self.changed = Signal()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _wanted(self, kind, filename, dest):
+        if self.events is not None and kind not in self.events:
+            return False
+        if kind == 'overflow':
+            return True
+        if self.polling and not self.recursive and \
+                os.path.dirname(filename) != self.root:
+            return False
+        match = self._match
+        return match is None or match(filename.name) is not None or \
+            (dest is not None and match(dest.name) is not None)
+
+    def read(self, timeout=None):
+        """ Return the list of events that happened since the last
+        call, waiting up to 'timeout' seconds (forever by default) for
+        the first one.  Returns an empty list on timeout or once the
+        watcher is closed.
+
+        Repeated modifications of a file are reported once per call.
+        If the kernel queue overflowed a WatchWarning is issued, and
+        an 'overflow' event tells that events were lost; rescan the
+        tree if you need to know exactly what changed.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        result = []
+        modified = set()
+        # Events that do not match 'pattern' or 'events' do not count:
+        # keep waiting until one does.
+        while not result and not self.closed:
+            if timeout is not None:
+                timeout = max(deadline - time.time(), 0)
+            for kind, filename, dest in self._source.read(timeout):
+                if kind == 'modified':
+                    if filename in modified:
+                        continue
+                    modified.add(filename)
+                else:
+                    modified.discard(filename)
+                if kind == 'overflow':
+                    warnings.warn("Events lost watching '%s'" % self.root,
+                                  WatchWarning)
+                if self._wanted(kind, filename, dest):
+                    result.append(WatchEvent(kind, filename, dest))
+            if timeout is not None and time.time() >= deadline:
+                break
+        return result
+
+    def __iter__(self):
+        while not self.closed:
+            for event in self.read(0.5):
+                yield event
+
+    def run(self):
+        """ Send the events to the 'changed' signal until close(). """
+        while not self.closed:
+            for event in self.read(0.5):
+                self.changed(event)
+
+    def close(self):
+        """ Stop watching.  Safe to call from another thread. """
+        self.closed = True
+        self._source.close()
+
+if 'trollius' in globals() and 'ThreadPoolExecutor' in globals():
+    __all__.append('AsyncPath')
+
+    class AsyncPath(object):
+        """
+        Non-blocking versions of the path methods, for code running on
+        a trollius event loop.  Get one with path.aio; it is only
+        defined when the trollius and futures packages are installed.
+        Each call runs the path method on a thread pool and returns a
+        future of its result, so a slow filesystem does not stall the
+        loop:
+
+            @trollius.coroutine
+            def load(d):
+                data = yield trollius.From(d.aio.bytes())
+                raise trollius.Return(data)
+
+        The pool is shared by all AsyncPaths and holds 'max_workers'
+        threads, unless set_default_executor() gives another one or
+        an executor is passed to the constructor.
+        """
+
+        max_workers = 8
+        _executor = []
+        _executor_lock = threading.Lock()
+
+        def __init__(self, p, loop=None, executor=None):
+            self.path = path(p)
+            self.loop = loop
+            self.executor = executor
+
+        def __repr__(self):
+            return '%s(%r)' % (type(self).__name__, self.path)
+
+        @classmethod
+        def default_executor(cls):
+            """ Return the shared executor, making it on first use. """
+            with cls._executor_lock:
+                if not cls._executor:
+                    cls._executor.append(ThreadPoolExecutor(cls.max_workers))
+                return cls._executor[0]
+
+        @classmethod
+        def set_default_executor(cls, executor):
+            """ Use 'executor' instead of the shared thread pool. """
+            with cls._executor_lock:
+                cls._executor[:] = [executor]
+
+        def _loop(self):
+            return self.loop or trollius.get_event_loop()
+
+        def _run(self, func, *args, **kwargs):
+            if kwargs:
+                func = functools.partial(func, **kwargs)
+            return self._loop().run_in_executor(
+                self.executor or self.default_executor(), func, *args)
+
+        def bytes(self):
+            return self._run(self.path.bytes)
+
+        def text(self, encoding=None, errors='strict'):
+            return self._run(self.path.text, encoding, errors)
+
+        def lines(self, encoding=None, errors='strict', retain=True):
+            return self._run(self.path.lines, encoding, errors, retain)
+
+        def write_bytes(self, bytes, append=False, atomic=False):
+            return self._run(self.path.write_bytes, bytes, append, atomic)
+
+        def write_text(self, text, encoding=None, errors='strict',
+                       linesep=os.linesep, append=False, atomic=False):
+            return self._run(self.path.write_text, text, encoding, errors,
+                             linesep, append, atomic)
+
+        def stat(self):
+            return self._run(self.path.stat)
+
+        def exists(self):
+            return self._run(self.path.exists)
+
+        def isdir(self):
+            return self._run(self.path.isdir)
+
+        def isfile(self):
+            return self._run(self.path.isfile)
+
+        def listdir(self, pattern=None):
+            return self._run(self.path.listdir, pattern)
+
+        def read_hexhash(self, hash_name, cache=None):
+            return self._run(self.path.read_hexhash, hash_name, cache)
+
+        def walk(self, pattern=None, errors='strict', batch=256):
+            """ Walk the tree as path.walk() does, without blocking.
+
+            The tree is walked on the executor 'batch' items at a time.
+            Returns an _AsyncWalk, whose get() gives a future of the
+            next path, or of None at the end:
+
+                walker = d.aio.walk('*.py')
+                while True:
+                    p = yield trollius.From(walker.get())
+                    if p is None:
+                        break
+            """
+            return _AsyncWalk(self, self.path.walk(pattern, errors), batch)
+
+    class _AsyncWalk(object):
+        """ The walker returned by AsyncPath.walk(). """
+
+        def __init__(self, aio, iterator, batch):
+            self._aio = aio
+            self._iterator = iterator
+            self._batch = batch
+            self._buffer = collections.deque()
+            # Held while the walk is advanced, so calls of get() that
+            # overlap never run the generator on two threads at once.
+            self._lock = threading.Lock()
+
+        def _fill(self):
+            with self._lock:
+                if not self._buffer:
+                    self._buffer.extend(
+                        itertools.islice(self._iterator, self._batch))
+                return self._buffer.popleft() if self._buffer else None
+
+        def get(self):
+            """ Return a future of the next path, or of None at the end. """
+            # Serve from the buffer without waiting for a batch being
+            # read on the executor, which would block the loop.
+            if self._lock.acquire(False):
+                try:
+                    if self._buffer:
+                        future = trollius.Future(loop=self._aio._loop())
+                        future.set_result(self._buffer.popleft())
+                        return future
+                finally:
+                    self._lock.release()
+            return self._aio._run(self._fill)
+
+if __name__ == '__main__':
+    # Benchmark the walk methods against the listdir() + isdir()/isfile()
+    # traversal they used before switching to scandir():
+    #
+    #   python -m foundation.paths [directory] [rounds]
+
+    def listdir_walk(d):
+        for child in d.listdir():
+            yield child
+            if child.isdir():
+                for item in listdir_walk(child):
+                    yield item
+
+    def listdir_walkfiles(d):
+        for child in d.listdir():
+            if child.isfile():
+                yield child
+            elif child.isdir():
+                for item in listdir_walkfiles(child):
+                    yield item
+
+    def best_of(rounds, func):
+        best, count = None, 0
+        for i in range(rounds):
+            start = time.time()
+            count = sum(1 for item in func())
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, count
+
+    root = path(sys.argv[1] if len(sys.argv) > 1 else sys.prefix)
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    print 'walking %s, best of %d rounds (scandir: %s)' % (
+        root, rounds, 'scandir' in globals())
+    for name, old, new in (
+            ('walk', lambda: listdir_walk(root), root.walk),
+            ('walkfiles', lambda: listdir_walkfiles(root), root.walkfiles)):
+        old_time, old_count = best_of(rounds, old)
+        new_time, new_count = best_of(rounds, new)
+        assert old_count == new_count, (old_count, new_count)
+        print '%-10s %8d items  listdir: %.3fs  scandir: %.3fs  (%.1fx)' % (
+            name, new_count, old_time, new_time, old_time / (new_time or 1e-9))
+
@@ -0,0 +1,418 @@
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import time
+import unittest
+
+from foundation import paths
+from foundation.paths import (path, find_duplicates, GroupCommit,
+                              FileIndex, CopyStats)
+
+
+class TreeTestCase(unittest.TestCase):
+    """ Gives each test an empty temporary directory, self.tmp. """
+
+    def setUp(self):
+        self.tmp = path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_tree(self, root, files):
+        """ Create the files in 'files', a dict of relative path ->
+        content, under 'root'.
+        """
+        root = path(root)
+        for rel, content in files.items():
+            f = root / rel
+            if not f.parent.isdir():
+                f.parent.makedirs()
+            f.write_bytes(content)
+        return root
+
+
+class SyncToTest(TreeTestCase):
+
+    def test_mirror(self):
+        src = self.make_tree(self.tmp / 'src', {
+            'a': 'aaa', 'd/b': 'bbb', 'd/e/c': 'ccc'})
+        dest = self.tmp / 'dest'
+        report = src.sync_to(dest)
+        self.assertEqual(sorted(report.added), ['a', 'd/b', 'd/e/c'])
+        self.assertEqual(report.errors, [])
+        self.assertEqual((dest / 'd/e/c').bytes(), 'ccc')
+
+        report = src.sync_to(dest)
+        self.assertEqual(report.unchanged, 3)
+        self.assertFalse(report.changed)
+
+    def test_update_and_delete(self):
+        src = self.make_tree(self.tmp / 'src', {'a': 'aaa', 'b': 'bbb'})
+        dest = self.tmp / 'dest'
+        src.sync_to(dest)
+        (src / 'a').write_bytes('new content')
+        (src / 'b').remove()
+        (dest / 'extra').write_bytes('x')
+        report = src.sync_to(dest, delete=True)
+        self.assertEqual(report.updated, ['a'])
+        self.assertEqual(sorted(report.removed), ['b', 'extra'])
+        self.assertEqual(sorted(dest.listdir()), [dest / 'a'])
+        self.assertEqual((dest / 'a').bytes(), 'new content')
+
+    def test_checksum(self):
+        src = self.make_tree(self.tmp / 'src', {'a': 'aaa', 'b': 'bbb'})
+        dest = self.tmp / 'dest'
+        src.sync_to(dest)
+        # Same size and time, different content.
+        (dest / 'a').write_bytes('zzz')
+        os.utime(dest / 'a', (os.stat(src / 'a').st_atime,
+                              os.stat(src / 'a').st_mtime))
+        self.assertEqual(src.sync_to(dest).unchanged, 2)
+        report = src.sync_to(dest, checksum=True)
+        self.assertEqual(report.updated, ['a'])
+        self.assertEqual(report.unchanged, 1)
+        self.assertEqual((dest / 'a').bytes(), 'aaa')
+
+    def test_symlink_in_dest_not_followed(self):
+        src = self.make_tree(self.tmp / 'src', {'f': 'new', 'g': 'g'})
+        outside = self.tmp / 'outside'
+        outside.write_bytes('old')
+        dest = self.tmp / 'dest'
+        dest.mkdir()
+        os.symlink(outside, dest / 'f')
+        os.symlink(self.tmp / 'missing', dest / 'g')
+        report = src.sync_to(dest)
+        self.assertEqual(report.errors, [])
+        self.assertEqual(sorted(report.updated), ['f', 'g'])
+        self.assertEqual(outside.bytes(), 'old')
+        for name in 'f', 'g':
+            self.assertFalse((dest / name).islink())
+            self.assertEqual((dest / name).bytes(), (src / name).bytes())
+        self.assertEqual(src.sync_to(dest).unchanged, 2)
+
+
+class SnapshotToTest(TreeTestCase):
+
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        self.src = self.make_tree(self.tmp / 'src', dict(
+            ('f%d' % i, os.urandom(1000)) for i in range(5)))
+
+    def test_link_unchanged(self):
+        src, s1, s2 = self.src, self.tmp / 's1', self.tmp / 's2'
+        report = src.snapshot_to(s1)
+        self.assertEqual(len(report.added), 5)
+        (src / 'f0').write_bytes('changed')
+        report = src.snapshot_to(s2, link_dest=s1)
+        self.assertEqual(report.unchanged, 4)
+        self.assertEqual(report.updated, ['f0'])
+        self.assertEqual((s2 / 'f0').bytes(), 'changed')
+        self.assertTrue(os.path.samefile(s1 / 'f1', s2 / 'f1'))
+        self.assertFalse(os.path.samefile(s1 / 'f0', s2 / 'f0'))
+
+    def test_manifest_lists_snapshot_times(self):
+        s1 = self.tmp / 's1'
+        self.src.snapshot_to(s1, checksum=True)
+        lines = (s1 / '.snapshot-manifest').lines(retain=False)
+        self.assertEqual(len(lines), 5)
+        for line in lines:
+            fields = line.split('\t')
+            f = s1 / fields[0]
+            st = os.stat(f)
+            self.assertEqual(int(fields[1]), st.st_size)
+            self.assertAlmostEqual(int(fields[2]) / 1e9, st.st_mtime, 5)
+            self.assertEqual(fields[3], hashlib.sha1(f.bytes()).hexdigest())
+
+    def test_checksum_trusts_previous_manifest(self):
+        src, s1, s2 = self.src, self.tmp / 's1', self.tmp / 's2'
+        src.snapshot_to(s1, checksum=True)
+        hashed = []
+        original = path.__dict__['_hashes']
+        path._hashes = lambda self, names: \
+            hashed.append(self) or original(self, names)
+        try:
+            report = src.snapshot_to(s2, link_dest=s1, checksum=True)
+        finally:
+            path._hashes = original
+        self.assertEqual(report.unchanged, 5)
+        self.assertEqual([p for p in hashed if p.startswith(s1)], [])
+
+
+class RmtreeFastTest(TreeTestCase):
+
+    def test_delete(self):
+        files = {}
+        for i in range(4):
+            for j in range(10):
+                files['d%d/e%d/f' % (i, j)] = 'x'
+                files['d%d/g%d' % (i, j)] = 'y'
+        root = self.make_tree(self.tmp / 'root', files)
+        (root / 'empty').mkdir()
+        os.symlink(self.tmp, root / 'link')
+        self.assertEqual(root.rmtree_fast(workers=3), [])
+        self.assertFalse(root.exists())
+        self.assertTrue(self.tmp.isdir())
+
+    def test_deep(self):
+        root = self.tmp / 'root'
+        for i in range(6):
+            os.makedirs(os.path.join(root, 'c%d' % i, *['d'] * 600))
+        self.assertEqual(root.rmtree_fast(workers=2), [])
+        self.assertFalse(root.exists())
+
+    def test_missing(self):
+        errors = (self.tmp / 'missing').rmtree_fast()
+        self.assertEqual(len(errors), 1)
+
+
+class GrepTest(TreeTestCase):
+
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        self.lines = ['line %d%s' % (i, ' ERR' if i % 37 == 0 else '')
+                      for i in range(1, 2000)]
+        self.make_tree(self.tmp, {
+            'a.log': '\n'.join(self.lines) + '\n',
+            'd/b.log': 'x\r\nERR y\r\n',
+            'd/c.txt': 'ERR',
+            'bin.log': '\0ERR'})
+        self.expected = sorted(
+            [(self.tmp / 'a.log', i, line)
+             for i, line in enumerate(self.lines, 1) if 'ERR' in line] +
+            [(self.tmp / 'd/b.log', 2, 'ERR y')])
+
+    def test_grep(self):
+        for workers in 1, 3:
+            self.assertEqual(
+                sorted(self.tmp.grep('ERR', '*.log', workers=workers)),
+                self.expected)
+
+    def test_line_numbers_across_chunks(self):
+        chunk = paths._GREP_COUNT_CHUNK
+        paths._GREP_COUNT_CHUNK = 7
+        try:
+            found = list((self.tmp / 'a.log').grep('ERR', workers=1))
+        finally:
+            paths._GREP_COUNT_CHUNK = chunk
+        self.assertEqual(found, [e for e in self.expected
+                                 if e[0].name == 'a.log'])
+
+
+class CopyTreeTest(TreeTestCase):
+
+    def test_ignore_and_symlinks(self):
+        src = self.make_tree(self.tmp / 'src', {
+            'a': 'aaa', 'b.pyc': 'x', 'd/c': 'ccc'})
+        os.symlink('a', src / 'link')
+        stats = src.copytree(self.tmp / 'dst', symlinks=True,
+                             ignore=shutil.ignore_patterns('*.pyc'))
+        dst = self.tmp / 'dst'
+        self.assertEqual(stats.files, 2)
+        self.assertEqual(sorted(f.name for f in dst.listdir()),
+                         ['a', 'd', 'link'])
+        self.assertEqual((dst / 'link').readlink(), 'a')
+        self.assertEqual((dst / 'd/c').bytes(), 'ccc')
+
+    def test_existing_destination(self):
+        src = self.make_tree(self.tmp / 'src', {'a': 'aaa'})
+        dst = self.tmp / 'dst'
+        dst.mkdir()
+        for copy in (src.copytree, src.copy_verified, src.snapshot_to):
+            try:
+                copy(dst)
+            except OSError, e:
+                self.assertEqual(e.errno, errno.EEXIST)
+            else:
+                self.fail('%s did not raise' % copy.__name__)
+        self.assertEqual(dst.listdir(), [])
+
+
+class CopyVerifiedTest(TreeTestCase):
+
+    def test_file(self):
+        src = self.tmp / 'src'
+        src.write_bytes(os.urandom(100000))
+        (self.tmp / 'dir').mkdir()
+        digest, stats = src.copy_verified(self.tmp / 'dir', verify=True)
+        self.assertEqual(digest, hashlib.sha256(src.bytes()).hexdigest())
+        self.assertIsInstance(stats, CopyStats)
+        self.assertEqual(stats.bytes, 100000)
+        self.assertEqual((self.tmp / 'dir/src').bytes(), src.bytes())
+
+    def test_tree(self):
+        src = self.make_tree(self.tmp / 'src', {'a': 'aaa', 'd/b': 'bbb'})
+        digests, stats = src.copy_verified(self.tmp / 'dst', 'md5')
+        self.assertEqual(digests, {
+            'a': hashlib.md5('aaa').hexdigest(),
+            os.path.join('d', 'b'): hashlib.md5('bbb').hexdigest()})
+        self.assertEqual(stats.files, 2)
+        self.assertEqual((self.tmp / 'dst/d/b').bytes(), 'bbb')
+
+
+class FindDuplicatesTest(TreeTestCase):
+
+    def test_link(self):
+        data = os.urandom(5000)
+        root = self.make_tree(self.tmp / 'root', {
+            'a': data, 'd/b': data, 'c': os.urandom(5000), 'e': data[:-1]})
+        groups = list(find_duplicates(root, workers=1, link=True))
+        self.assertEqual(groups, [[root / 'a', root / 'd/b']])
+        self.assertTrue(os.path.samefile(root / 'a', root / 'd/b'))
+        # Hard links are not reported again.
+        self.assertEqual(list(find_duplicates(root, workers=1)), [])
+
+
+class GroupCommitTest(TreeTestCase):
+
+    def test_commit(self):
+        a, b = self.tmp / 'a', self.tmp / 'b'
+        a.write_bytes('old')
+        with GroupCommit():
+            a.write_bytes('new', atomic=True)
+            b.write_bytes('b', atomic=True)
+            self.assertEqual(a.bytes(), 'old')
+            self.assertFalse(b.exists())
+        self.assertEqual(a.bytes(), 'new')
+        self.assertEqual(b.bytes(), 'b')
+        self.assertEqual(sorted(self.tmp.listdir()), [a, b])
+
+    def test_abort(self):
+        a = self.tmp / 'a'
+        a.write_bytes('old')
+        try:
+            with GroupCommit():
+                a.write_bytes('new', atomic=True)
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertEqual(a.bytes(), 'old')
+        self.assertEqual(self.tmp.listdir(), [a])
+
+    def test_failed_rename(self):
+        a, b, c = self.tmp / 'a', self.tmp / 'b', self.tmp / 'c'
+        (b / 'sub').makedirs()
+        try:
+            with GroupCommit():
+                a.write_bytes('a', atomic=True)
+                # A file can not be renamed over a directory.
+                b.write_bytes('b', atomic=True)
+                c.write_bytes('c', atomic=True)
+        except OSError:
+            pass
+        else:
+            self.fail('the commit did not fail')
+        self.assertEqual(a.bytes(), 'a')
+        self.assertTrue(b.isdir())
+        self.assertFalse(c.exists())
+        self.assertEqual(sorted(self.tmp.listdir()), [a, b])
+
+
+class FileIndexTest(TreeTestCase):
+
+    def setUp(self):
+        TreeTestCase.setUp(self)
+        self.root = self.make_tree(self.tmp / 'root', {
+            'a.txt': 'a', 'b.TXT': 'bb', 'img_1.dcm': 'x' * 100,
+            'sub/c.txt': 'ccc', 'sub/deep/d.dcm': 'dddd'})
+        self.index = FileIndex(self.tmp / 'index.db', self.root)
+
+    def tearDown(self):
+        self.index.close()
+        TreeTestCase.tearDown(self)
+
+    def query(self, **kwargs):
+        return sorted(self.root.relpathto(f)
+                      for f in self.index.query(**kwargs))
+
+    def test_query(self):
+        self.index.refresh()
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.query(ext='.txt'),
+                         ['a.txt', 'b.TXT', 'sub/c.txt'])
+        self.assertEqual(self.query(min_size=3, max_size=4),
+                         ['sub/c.txt', 'sub/deep/d.dcm'])
+        self.assertEqual(self.query(under='sub'),
+                         ['sub/c.txt', 'sub/deep/d.dcm'])
+        self.assertEqual(self.query(pattern='img_*'), ['img_1.dcm'])
+        self.assertEqual(
+            [f.name for f in self.index.query(order_by='-size', limit=2)],
+            ['img_1.dcm', 'd.dcm'])
+
+    def test_pattern(self):
+        self.index.refresh()
+        self.assertEqual(self.query(pattern='[!ab]*'),
+                         ['img_1.dcm', 'sub/c.txt', 'sub/deep/d.dcm'])
+        self.assertEqual(self.query(pattern='*.TXT'), ['b.TXT'])
+        self.assertEqual(
+            [f.name for f in self.index.query(pattern='?.*',
+                                              order_by='size', limit=2)],
+            ['a.txt', 'b.TXT'])
+
+    def test_refresh(self):
+        self.assertEqual(self.index.refresh(), 3)
+        self.assertEqual(self.index.refresh(), 0)
+        (self.root / 'sub/new.txt').write_bytes('n')
+        self.assertEqual(self.index.refresh(), 1)
+        (self.root / 'a.txt').remove()
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertEqual(self.query(ext='.txt'),
+                         ['b.TXT', 'sub/c.txt', 'sub/new.txt'])
+
+
+class WatchTest(TreeTestCase):
+
+    def check_created(self, poll):
+        with self.tmp.watch(poll=poll, interval=0.1) as w:
+            self.assertEqual(w.read(0.3), [])
+            (self.tmp / 'sub').mkdir()
+            (self.tmp / 'sub' / 'f').write_bytes('x')
+            events = []
+            deadline = time.time() + 5
+            while len(events) < 2 and time.time() < deadline:
+                events.extend(e for e in w.read(0.5)
+                              if e.kind == 'created')
+            self.assertEqual(sorted(e.path for e in events),
+                             [self.tmp / 'sub', self.tmp / 'sub' / 'f'])
+
+    def test_poll(self):
+        self.check_created(True)
+
+    def test_native(self):
+        self.check_created(None)
+
+    def check_filtered(self, poll):
+        with self.tmp.watch(poll=poll, pattern='*.log', events=['created'],
+                            interval=0.1) as w:
+            (self.tmp / 'a.txt').write_bytes('x')
+            # read() waits past the events that do not match.
+            threading.Timer(
+                0.5, (self.tmp / 'b.log').write_bytes, ['x']).start()
+            events = w.read()
+            self.assertEqual([e.path for e in events], [self.tmp / 'b.log'])
+
+    def test_poll_filtered(self):
+        self.check_filtered(True)
+
+    def test_native_filtered(self):
+        self.check_filtered(None)
+
+    def check_close(self, poll):
+        w = self.tmp.watch(poll=poll, interval=0.1)
+        threading.Timer(0.3, w.close).start()
+        start = time.time()
+        self.assertEqual(w.read(), [])
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(w.read(), [])
+
+    def test_poll_close(self):
+        self.check_close(True)
+
+    def test_native_close(self):
+        self.check_close(None)
+
+
+if __name__ == '__main__':
+    unittest.main()